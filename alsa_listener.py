@@ -1,9 +1,9 @@
 import sys
+import math
 import time
 import select
 import threading
-from copy import deepcopy
-from typing import Callable
+from typing import Any, Callable
 
 from dataclasses import dataclass
 from enum import Enum
@@ -11,7 +11,7 @@ from enum import Enum
 from pyalsa import alsahcontrol
 
 from device_listener import DeviceListener
-from datastructures import WaveFormat, DeviceEvent
+from datastructures import WaveFormat, DeviceEvent, ListenerEvent
 
 LOOPBACK_ACTIVE = "PCM Slave Active"
 LOOPBACK_CHANNELS = "PCM Slave Channels"
@@ -92,26 +92,175 @@ def alsa_format_to_cdsp(fmt):
         return "FLOAT64LE"
 
 
+# Element events that mean the value must be read again
+VALUE_CHANGED_MASK = alsahcontrol.event_mask["VALUE"] | alsahcontrol.event_mask["INFO"]
+
+
 @dataclass
 class Control:
     index: int | None
     element: alsahcontrol.Element | None
     value_transform_func: Callable | None
+    info: alsahcontrol.Info | None = None
+    value: alsahcontrol.Value | None = None
+    cached_value: Any = None
+    changed: bool = True
+    change_count: int = 0
+
+    def on_event(self, _element, mask):
+        """
+        Callback for element events, called by HControl.handle_events().
+        """
+        if mask == alsahcontrol.event_mask_remove or mask & VALUE_CHANGED_MASK:
+            self.changed = True
+            self.change_count += 1
+
+
+class AlsaCard:
+    """
+    An open hctl handle for a card, with the list of all its controls.
+    The control list is read once, and shared by all listeners for devices on the card.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.hctl = alsahcontrol.HControl(name, mode=alsahcontrol.open_mode["NONBLOCK"])
+        self.controls = self.hctl.list()
+
+
+class AlsaPoller:
+    """
+    Poll the hctl handles of one or more cards in a single thread,
+    and let the listeners for the devices on these cards determine if they should emit events.
+    By default, a fixed 'debounce_time' is waited after each event before the controls are read.
+    In adaptive mode, the controls are read as soon as they have been stable for 'quiet_time',
+    or when 'max_settle_time' has passed since the first event.
+    """
+
+    def __init__(
+        self, debounce_time=0.05, adaptive=False, quiet_time=0.01, max_settle_time=0.1
+    ):
+        self.debounce_time = debounce_time
+        self.adaptive = adaptive
+        self.quiet_time = quiet_time
+        self.max_settle_time = max_settle_time
+        self.poller = select.poll()
+        self.cards = {}
+        self.listeners = []
+        self.poll_thread = None
+        self.lock = threading.Lock()
+        # Serializes the event handling and the control reads,
+        # that are done both by the polling thread and by the controller.
+        self.read_lock = threading.RLock()
+
+    def get_card(self, name):
+        """
+        Return the AlsaCard with the given name, opening it if needed.
+        """
+        with self.lock:
+            if name not in self.cards:
+                if self.poll_thread is not None:
+                    raise RuntimeError("Cards can't be added while polling")
+                card = AlsaCard(name)
+                card.hctl.register_poll(self.poller)
+                self.cards[name] = card
+            return self.cards[name]
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def handle_events(self):
+        with self.read_lock:
+            for card in self.cards.values():
+                card.hctl.handle_events()
+
+    def count_changes(self):
+        return sum(listener.count_changes() for listener in self.listeners)
+
+    def wait_until_settled(self, wakeup_time):
+        """
+        Keep handling events until the relevant controls have been quiet for 'quiet_time',
+        but no longer than 'max_settle_time' after the first event.
+        """
+        self.handle_events()
+        changes = self.count_changes()
+        last_change = time.monotonic()
+        deadline = wakeup_time + self.max_settle_time
+        while True:
+            now = time.monotonic()
+            timeout = min(last_change + self.quiet_time, deadline) - now
+            if timeout <= 0:
+                return
+            if self.poller.poll(math.ceil(1000 * timeout)):
+                self.handle_events()
+                new_changes = self.count_changes()
+                if new_changes != changes:
+                    # A relevant control changed, restart the quiet period
+                    changes = new_changes
+                    last_change = time.monotonic()
+
+    def pollingloop(self):
+        while True:
+            pollres = self.poller.poll()
+            if pollres:
+                wakeup_time = time.monotonic()
+                if self.adaptive:
+                    self.wait_until_settled(wakeup_time)
+                    debounced_time = time.monotonic()
+                else:
+                    time.sleep(self.debounce_time)
+                    debounced_time = time.monotonic()
+                    self.handle_events()
+                for listener in self.listeners:
+                    listener.wakeup_time = wakeup_time
+                    listener.debounced_time = debounced_time
+                    listener.determine_action()
+
+    def run(self):
+        """
+        Start the polling thread. Does nothing if it is already running.
+        """
+        with self.lock:
+            if self.poll_thread is None:
+                self.poll_thread = threading.Thread(target=self.pollingloop, daemon=True)
+                self.poll_thread.start()
 
 
 class AlsaControlListener(DeviceListener):
-    def __init__(self, device, debounce_time=0.05):
+    """
+    Listen to the controls of an ALSA Loopback or USB gadget device.
+    The timing parameters are described in AlsaPoller.
+    Several listeners can share a single AlsaPoller, see MultiAlsaControlListener.
+    """
+
+    def __init__(
+        self,
+        device,
+        debounce_time=0.05,
+        adaptive=False,
+        quiet_time=0.01,
+        max_settle_time=0.1,
+        alsa_poller=None,
+    ):
 
         self.on_change = None
-
-        self.debounce_time = debounce_time
+        self.device = device
+
+        if alsa_poller is None:
+            alsa_poller = AlsaPoller(
+                debounce_time=debounce_time,
+                adaptive=adaptive,
+                quiet_time=quiet_time,
+                max_settle_time=max_settle_time,
+            )
+        self.alsa_poller = alsa_poller
         self.get_card_device_subdevice(device)
 
-        self.hctl = alsahcontrol.HControl(
-            self._card, mode=alsahcontrol.open_mode["NONBLOCK"]
-        )
+        card = self.alsa_poller.get_card(self._card)
+        self.hctl = card.hctl
 
-        self.all_device_controls = self.hctl.list()
+        self.all_device_controls = card.controls
 
         self.ctl_loopback_active = self.find_control(LOOPBACK_ACTIVE, INTERFACE_PCM)
         self.ctl_loopback_channels = self.find_control(LOOPBACK_CHANNELS, INTERFACE_PCM)
@@ -121,12 +270,11 @@ class AlsaControlListener(DeviceListener):
         self.ctl_loopback_rate = self.find_control(LOOPBACK_RATE, INTERFACE_PCM)
         self.ctl_gadget_rate = self.find_control(GADGET_CAP_RATE, INTERFACE_PCM)
 
-        self.poller = select.poll()
-        self.hctl.register_poll(self.poller)
-
-        self.poll_thread = None
+        self.wakeup_time = None
+        self.debounced_time = None
         self.wave_format = self.read_wave_format()
         self.is_active = self.check_if_active()
+        self.alsa_poller.add_listener(self)
 
     def find_control(self, name, interface, value_transform_func=None):
         index = self.find_element(name, interface)
@@ -135,9 +283,16 @@ class AlsaControlListener(DeviceListener):
         element = alsahcontrol.Element(self.hctl, index)
         if element is None:
             return None
-        return Control(
-            index=index, element=element, value_transform_func=value_transform_func
+        control = Control(
+            index=index,
+            element=element,
+            value_transform_func=value_transform_func,
+            info=alsahcontrol.Info(element),
+            value=alsahcontrol.Value(element),
         )
+        # Get notified when the element changes, to avoid reading unchanged values
+        element.set_callback(control.on_event)
+        return control
 
     def get_card_device_subdevice(self, dev):
         parts = dev.split(",")
@@ -169,23 +324,23 @@ class AlsaControlListener(DeviceListener):
                 break
         return found
 
-    def read_element_value(self, elem):
-        if elem is None:
-            return None
-        info = alsahcontrol.Info(elem)
-        val = alsahcontrol.Value(elem)
-        values = val.get_tuple(info.type, info.count)
-        val.set_tuple(info.type, values)
-        val.read()
-        return values[0]
-
     def read_control_value(self, ctl: Control | None):
+        """
+        Return the value of a control.
+        The value is only read from the device if it has changed since the last read.
+        """
         if ctl is None:
             return None
-        value = self.read_element_value(ctl.element)
-        if ctl.value_transform_func is not None:
-            return ctl.value_transform_func(value)
-        return value
+        with self.alsa_poller.read_lock:
+            if ctl.changed:
+                # Clear the flag first, a change during the read will trigger a new read next time.
+                ctl.changed = False
+                ctl.value.read()
+                value = ctl.value.get_tuple(ctl.info.type, ctl.info.count)[0]
+                if ctl.value_transform_func is not None:
+                    value = ctl.value_transform_func(value)
+                ctl.cached_value = value
+            return ctl.cached_value
 
     def check_if_active(self):
         gadget_rate = self.read_control_value(self.ctl_gadget_rate)
@@ -194,10 +349,14 @@ class AlsaControlListener(DeviceListener):
         return self.read_control_value(self.ctl_loopback_active)
 
     def read_wave_format(self):
-        loopback_rate = self.read_control_value(self.ctl_loopback_rate)
-        loopback_channels = self.read_control_value(self.ctl_loopback_channels)
-        loopback_format = self.read_control_value(self.ctl_loopback_format)
-        gadget_rate = self.read_control_value(self.ctl_gadget_rate)
+        # Read all the controls under the lock, so that they belong to the same event
+        with self.alsa_poller.read_lock:
+            # Dispatch pending element events first, the poll thread may not have done it yet
+            self.alsa_poller.handle_events()
+            loopback_rate = self.read_control_value(self.ctl_loopback_rate)
+            loopback_channels = self.read_control_value(self.ctl_loopback_channels)
+            loopback_format = self.read_control_value(self.ctl_loopback_format)
+            gadget_rate = self.read_control_value(self.ctl_gadget_rate)
         if gadget_rate is not None:
             return WaveFormat(
                 sample_format=None, channels=None, sample_rate=gadget_rate
@@ -208,52 +367,112 @@ class AlsaControlListener(DeviceListener):
             sample_rate=loopback_rate,
         )
 
+    def controls(self):
+        return (
+            self.ctl_loopback_active,
+            self.ctl_loopback_channels,
+            self.ctl_loopback_format,
+            self.ctl_loopback_rate,
+            self.ctl_gadget_rate,
+        )
+
+    def count_changes(self):
+        return sum(ctl.change_count for ctl in self.controls() if ctl is not None)
+
     def determine_action(self):
-        new_wave_format = self.read_wave_format()
-        new_active = self.check_if_active()
+        # The 'changed' flags are also cleared by reads from the controller,
+        # so compare with the last state seen here instead of relying on them.
+        # Unchanged controls are not read again, this is cheap when the event was for another control.
+        with self.alsa_poller.read_lock:
+            new_wave_format = self.read_wave_format()
+            new_active = self.check_if_active()
+        # WaveFormat is immutable, so the same object can be stored and sent with the events
         if not self.is_active and new_active:
             self.is_active = True
-            event = DeviceEvent.STARTED
-            event.set_data(deepcopy(new_wave_format))
-            self.emit_event(event)
+            self.emit_event(DeviceEvent.STARTED, new_wave_format)
         elif self.is_active and not new_active:
             self.is_active = False
-            event = DeviceEvent.STOPPED
-            self.emit_event(event)
+            self.emit_event(DeviceEvent.STOPPED)
         elif self.is_active and new_active and self.wave_format != new_wave_format:
-            stop_event = DeviceEvent.STOPPED
-            self.emit_event(stop_event)
-            start_event = DeviceEvent.STARTED
-            start_event.set_data(deepcopy(new_wave_format))
-            self.emit_event(start_event)
+            self.emit_event(DeviceEvent.STOPPED)
+            self.emit_event(DeviceEvent.STARTED, new_wave_format)
         self.wave_format = new_wave_format
 
-    def emit_event(self, event):
+    def emit_event(self, kind, wave_format=None):
+        if self.metrics is not None and self.wakeup_time is not None:
+            self.metrics.start_switch(self.wakeup_time)
+            self.metrics.mark("debounce", self.debounced_time)
         if self.on_change is not None:
-            self.on_change(event)
-
-    def pollingloop(self):
-        while True:
-            pollres = self.poller.poll()
-            if pollres:
-                time.sleep(self.debounce_time)
-                self.hctl.handle_events()
-                self.determine_action()
+            timestamp = self.wakeup_time if self.wakeup_time is not None else time.monotonic()
+            self.on_change(ListenerEvent(kind, wave_format, self.device, timestamp))
 
     def run(self):
-        self.poll_thread = threading.Thread(target=self.pollingloop, daemon=True)
-        self.poll_thread.start()
+        self.alsa_poller.run()
 
     def set_on_change(self, function):
         self.on_change = function
 
 
+class MultiAlsaControlListener(DeviceListener):
+    """
+    Listen to several ALSA devices, using a single polling thread.
+    Each card is opened, and its control list is read, only once.
+    The callback given to set_on_change() is called with the device name and the event.
+    The listener for a single device is available from listener(),
+    for use where a normal DeviceListener is needed.
+    """
+
+    def __init__(
+        self,
+        devices,
+        debounce_time=0.05,
+        adaptive=False,
+        quiet_time=0.01,
+        max_settle_time=0.1,
+    ):
+        self.alsa_poller = AlsaPoller(
+            debounce_time=debounce_time,
+            adaptive=adaptive,
+            quiet_time=quiet_time,
+            max_settle_time=max_settle_time,
+        )
+        self.listeners = {
+            device: AlsaControlListener(device, alsa_poller=self.alsa_poller)
+            for device in devices
+        }
+
+    def listener(self, device):
+        return self.listeners[device]
+
+    def run(self):
+        self.alsa_poller.run()
+
+    def set_on_change(self, function):
+        for device, listener in self.listeners.items():
+            listener.set_on_change(
+                lambda event, device=device: function(device, event)
+            )
+
+    def set_metrics(self, metrics):
+        for listener in self.listeners.values():
+            listener.set_metrics(metrics)
+
+    def read_wave_formats(self):
+        """
+        Read and return the current values for all devices, as a dictionary.
+        """
+        return {
+            device: listener.read_wave_format()
+            for device, listener in self.listeners.items()
+        }
+
+
 if __name__ == "__main__":
-    device = sys.argv[1]
-    listener = ControlListener(device, debounce_time=0.05)
+    devices = sys.argv[1:]
+    listener = MultiAlsaControlListener(devices, debounce_time=0.05)
 
-    def notifier(params):
-        print(params, params.data)
+    def notifier(device, params):
+        print(device, params)
 
     listener.set_on_change(notifier)
     listener.run()
@@ -0,0 +1,106 @@
+"""
+Micro-benchmark for the cost of serializing a config for SetConfigJson,
+comparing serializing on every start with reusing a PreparedConfig.
+
+Usage: python benchmarks/bench_payload.py [--fir-taps N] [--channels N] [--biquads N]
+"""
+
+import sys
+import json
+import timeit
+import argparse
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from datastructures import PreparedConfig
+
+
+def make_config(fir_taps, channels, biquads):
+    """
+    Build a large config with inline FIR coefficients, a full mixer and many biquads.
+    """
+    filters = {}
+    for ch in range(channels):
+        filters[f"fir_{ch}"] = {
+            "type": "Conv",
+            "parameters": {
+                "type": "Values",
+                "values": [1.0 / (n + 1) for n in range(fir_taps)],
+            },
+        }
+    for n in range(biquads):
+        filters[f"peq_{n}"] = {
+            "type": "Biquad",
+            "parameters": {"type": "Peaking", "freq": 20 + 10 * n, "q": 1.2, "gain": -1.5},
+        }
+    mapping = [
+        {
+            "dest": dest,
+            "sources": [
+                {"channel": src, "gain": -6.0, "inverted": False} for src in range(channels)
+            ],
+        }
+        for dest in range(channels)
+    ]
+    pipeline = [{"type": "Mixer", "name": "matrix"}]
+    for ch in range(channels):
+        pipeline.append(
+            {
+                "type": "Filter",
+                "channels": [ch],
+                "names": [f"fir_{ch}"] + [f"peq_{n}" for n in range(biquads)],
+            }
+        )
+    return {
+        "devices": {
+            "samplerate": 44100,
+            "chunksize": 1024,
+            "capture": {"type": "Alsa", "channels": channels, "device": "hw:Loopback,0"},
+            "playback": {"type": "Alsa", "channels": channels, "device": "hw:0"},
+        },
+        "filters": filters,
+        "mixers": {
+            "matrix": {
+                "channels": {"in": channels, "out": channels},
+                "mapping": mapping,
+            }
+        },
+        "pipeline": pipeline,
+    }
+
+
+def wire_message(payload):
+    # This is what the client does with the payload before sending it
+    return json.dumps({"SetConfigJson": payload})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Config serialization benchmark")
+    parser.add_argument("--fir-taps", type=int, default=16384)
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--biquads", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    config = make_config(args.fir_taps, args.channels, args.biquads)
+    prepared = PreparedConfig(config)
+    size = len(prepared.payload)
+
+    uncached = min(
+        timeit.repeat(lambda: wire_message(json.dumps(config)), number=1, repeat=args.repeat)
+    )
+    cached = min(
+        timeit.repeat(lambda: wire_message(prepared.payload), number=1, repeat=args.repeat)
+    )
+    result = {
+        "payload_bytes": size,
+        "serialize_every_start_ms": round(1000 * uncached, 3),
+        "prepared_payload_ms": round(1000 * cached, 3),
+        "saving_ms": round(1000 * (uncached - cached), 3),
+    }
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Startup benchmark, based on the import times reported by 'python -X importtime'.
+Imports the controller module in a fresh interpreter a number of times,
+and fails with exit code 1 if the median import time exceeds the budget.
+
+Usage: python benchmarks/bench_startup.py [--budget-ms 150] [--module controller]
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from os.path import dirname, abspath
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+
+
+def parse_importtime(output):
+    """
+    Parse the stderr output of 'python -X importtime'.
+    Returns a list of (module, self time in us, cumulative time in us) tuples.
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            # The header line
+            continue
+        imports.append((fields[2].strip(), self_us, cumulative_us))
+    return imports
+
+
+def measure(module):
+    """
+    Import a module in a new interpreter, and return the parsed import times.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (REPO_DIR, env.get("PYTHONPATH")) if path
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Controller startup benchmark")
+    parser.add_argument("--module", default="controller", help="Module to import")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--budget-ms", type=float, default=150, help="Maximum median import time"
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of the slowest imports to report"
+    )
+    args = parser.parse_args()
+
+    totals = []
+    slowest = {}
+    for _ in range(args.repeat):
+        imports = measure(args.module)
+        totals.append(sum(self_us for _, self_us, _ in imports))
+        for name, self_us, _ in imports:
+            slowest.setdefault(name, []).append(self_us)
+    median_ms = statistics.median(totals) / 1000
+    top = sorted(
+        ((name, statistics.median(times) / 1000) for name, times in slowest.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )[: args.top]
+    result = {
+        "module": args.module,
+        "median_import_ms": round(median_ms, 3),
+        "min_import_ms": round(min(totals) / 1000, 3),
+        "budget_ms": args.budget_ms,
+        "within_budget": median_ms <= args.budget_ms,
+        "slowest_self_ms": {name: round(ms, 3) for name, ms in top},
+    }
+    print(json.dumps(result))
+    if not result["within_budget"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+A stand-in for CamillaDSP, that implements the part of the websocket protocol used by the controller.
+It only uses the standard library, so that it can run on any machine without audio hardware.
+Faults can be injected, for testing how the controller handles a slow or unstable DSP:
+- a delay before each reply, per command,
+- a delay from a new config until the state is RUNNING,
+- scripted stops, with the same stop reasons as CamillaDSP,
+- rejecting configs for some sample rates,
+- a low buffer level for chunksizes that are too small for a glitch-free playback.
+
+Usage: python benchmarks/fake_camilladsp.py -p 1234 [--latency 0.01] [--latency Stop=0.1]
+                [--startup-delay 0.2] [--stop 1.0:CaptureFormatChange:48000] [--repeat-stops]
+"""
+
+import json
+import time
+import base64
+import struct
+import asyncio
+import hashlib
+import argparse
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+VERSION = "3.0.0"
+
+# Stop reasons that can be scripted, and the value sent with them
+STOP_REASONS = {
+    "CaptureFormatChange": int,
+    "CaptureError": str,
+    "PlaybackError": str,
+    "PlaybackFormatChange": int,
+    "Done": None,
+}
+
+
+def parse_stop(text):
+    """
+    Parse a scripted stop, given as AFTER:REASON[:VALUE].
+    AFTER is the time in seconds from when the DSP is running until it stops.
+    Returns a tuple of (after, stop reason as sent by CamillaDSP).
+    """
+    after, _, rest = text.partition(":")
+    reason, _, value = rest.partition(":")
+    if reason not in STOP_REASONS:
+        raise ValueError(f"Unknown stop reason {reason}, valid are {', '.join(STOP_REASONS)}")
+    value_type = STOP_REASONS[reason]
+    if value_type is None:
+        return float(after), reason
+    if value == "":
+        value = 0 if value_type is int else "Scripted error"
+    return float(after), {reason: value_type(value)}
+
+
+class FakeCamillaDSP:
+    """
+    The state of the fake CamillaDSP, and the handling of commands.
+    'latency' is the default delay in seconds before replying to a command,
+    and 'command_latency' a dictionary of delays for specific commands.
+    A new config is in the Starting state for 'startup_delay' seconds before it is Running.
+    'stops' is a list of scripted stops, as returned by parse_stop().
+    Each time the DSP starts running, the next scripted stop is scheduled.
+    With 'repeat_stops', the script starts over when all stops have been used.
+    Configs with a sample rate in 'reject_rates' are rejected.
+    The buffer level is the chunksize while running,
+    and a tenth of it if the chunksize is smaller than 'min_chunksize'.
+    The state is updated from the clock when a command is handled,
+    so the behavior does not depend on any background task.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        command_latency=None,
+        startup_delay=0.0,
+        stops=None,
+        repeat_stops=False,
+        reject_rates=None,
+        min_chunksize=0,
+    ):
+        self.state = "Inactive"
+        self.stop_reason = "None"
+        self.config = None
+        self.command_counts = {}
+        self.latency = latency
+        self.command_latency = command_latency if command_latency is not None else {}
+        self.startup_delay = startup_delay
+        self.stops = list(stops) if stops is not None else []
+        self.repeat_stops = repeat_stops
+        self.next_stop = 0
+        self.reject_rates = set(reject_rates) if reject_rates is not None else set()
+        self.min_chunksize = min_chunksize
+        self.running_at = None
+        self.stop_at = None
+        self.scheduled_reason = None
+
+    def delay_for(self, command):
+        return self.command_latency.get(command, self.latency)
+
+    def start(self):
+        self.running_at = time.monotonic() + self.startup_delay
+        self.state = "Starting" if self.startup_delay > 0 else "Running"
+        self.stop_reason = "None"
+        self.stop_at = None
+        if self.next_stop < len(self.stops):
+            after, self.scheduled_reason = self.stops[self.next_stop]
+            self.stop_at = self.running_at + after
+            self.next_stop += 1
+            if self.repeat_stops and self.next_stop == len(self.stops):
+                self.next_stop = 0
+
+    def update(self):
+        """
+        Advance the state to the current time.
+        """
+        now = time.monotonic()
+        if self.state == "Starting" and now >= self.running_at:
+            self.state = "Running"
+        if self.state == "Running" and self.stop_at is not None and now >= self.stop_at:
+            self.state = "Inactive"
+            self.stop_reason = self.scheduled_reason
+            self.stop_at = None
+
+    def handle_command(self, command, arg):
+        """
+        Handle a command, and return a tuple of result ("Ok" or "Error") and value.
+        """
+        self.command_counts[command] = self.command_counts.get(command, 0) + 1
+        self.update()
+        if command == "GetVersion":
+            return "Ok", VERSION
+        if command == "GetState":
+            return "Ok", self.state
+        if command == "GetStopReason":
+            return "Ok", self.stop_reason
+        if command == "GetBufferLevel":
+            if self.state != "Running":
+                return "Ok", 0
+            chunksize = self.config.get("devices", {}).get("chunksize", 1024)
+            if chunksize < self.min_chunksize:
+                return "Ok", chunksize // 10
+            return "Ok", chunksize
+        if command == "GetRateAdjust":
+            return "Ok", 1.0
+        if command == "Stop":
+            self.state = "Inactive"
+            self.stop_reason = "None"
+            self.stop_at = None
+            return "Ok", None
+        if command == "SetConfigJson":
+            try:
+                config = json.loads(arg)
+            except (TypeError, ValueError) as e:
+                return "Error", f"Invalid config: {e}"
+            rate = config.get("devices", {}).get("samplerate") if isinstance(config, dict) else None
+            if rate in self.reject_rates:
+                return "Error", f"Unsupported sample rate {rate}"
+            self.config = config
+            self.start()
+            return "Ok", None
+        if command == "ValidateConfig":
+            try:
+                config = json.loads(arg)
+            except (TypeError, ValueError) as e:
+                return "Error", f"Invalid config: {e}"
+            if not isinstance(config, dict) or "devices" not in config:
+                return "Error", "Missing field `devices`"
+            return "Ok", json.dumps(config)
+        if command == "GetConfigJson":
+            return "Ok", json.dumps(self.config)
+        return "Error", f"Unsupported command: {command}"
+
+    @staticmethod
+    def parse_message(message):
+        """
+        Parse a message from a client, and return the command and its argument.
+        """
+        request = json.loads(message)
+        if isinstance(request, str):
+            return request, None
+        return next(iter(request.items()))
+
+    def handle_message(self, message):
+        """
+        Parse a message from a client and return the reply.
+        """
+        command, arg = self.parse_message(message)
+        return self.reply(command, arg)
+
+    def reply(self, command, arg):
+        result, value = self.handle_command(command, arg)
+        reply = {"result": result}
+        if value is not None:
+            reply["value"] = value
+        return json.dumps({command: reply})
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(2)
+    opcode = header[0] & 0x0F
+    masked = header[1] & 0x80
+    length = header[1] & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", await reader.readexactly(8))
+    mask = await reader.readexactly(4) if masked else None
+    payload = await reader.readexactly(length)
+    if mask is not None:
+        payload = bytes(b ^ mask[n % 4] for n, b in enumerate(payload))
+    return opcode, payload
+
+
+def encode_frame(opcode, payload):
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 65536:
+        header += bytes([126]) + struct.pack("!H", length)
+    else:
+        header += bytes([127]) + struct.pack("!Q", length)
+    return header + payload
+
+
+async def handshake(reader, writer):
+    request = await reader.readuntil(b"\r\n\r\n")
+    key = None
+    for line in request.decode().split("\r\n"):
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "sec-websocket-key":
+            key = value.strip()
+    if key is None:
+        writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+        return False
+    accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest())
+    writer.write(
+        b"HTTP/1.1 101 Switching Protocols\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+    )
+    await writer.drain()
+    return True
+
+
+async def serve_client(dsp, reader, writer):
+    try:
+        if not await handshake(reader, writer):
+            return
+        while True:
+            opcode, payload = await read_frame(reader)
+            if opcode == OPCODE_CLOSE:
+                writer.write(encode_frame(OPCODE_CLOSE, payload[:2]))
+                await writer.drain()
+                return
+            if opcode == OPCODE_PING:
+                writer.write(encode_frame(OPCODE_PONG, payload))
+            elif opcode == OPCODE_TEXT:
+                command, arg = dsp.parse_message(payload.decode())
+                delay = dsp.delay_for(command)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                reply = dsp.reply(command, arg)
+                writer.write(encode_frame(OPCODE_TEXT, reply.encode()))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(dsp, host, port, started=None):
+    """
+    Serve the fake CamillaDSP until cancelled.
+    If 'started' is an asyncio.Event, it is set once the server is listening.
+    """
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_client(dsp, reader, writer), host, port
+    )
+    if started is not None:
+        started.set()
+    async with server:
+        await server.serve_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fake CamillaDSP websocket server")
+    parser.add_argument("-p", "--port", help="Websocket port", type=int, required=True)
+    parser.add_argument("--host", help="Websocket host", default="localhost")
+    parser.add_argument(
+        "--latency",
+        help="Delay in seconds before replying, as SECONDS for all commands or COMMAND=SECONDS. "
+        "Can be given several times.",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--startup-delay",
+        help="Time in seconds from a new config until the state is Running",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--stop",
+        help="Scripted stop, as AFTER:REASON[:VALUE], for example 1.0:CaptureFormatChange:48000. "
+        "Can be given several times, each start uses the next one.",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--repeat-stops", help="Start over when all scripted stops are used", action="store_true"
+    )
+    parser.add_argument(
+        "--reject-rate",
+        help="Reject configs with this sample rate. Can be given several times.",
+        type=int,
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--min-chunksize",
+        help="Report a low buffer level when running with a smaller chunksize than this",
+        type=int,
+        default=0,
+    )
+    args = parser.parse_args()
+    latency = 0.0
+    command_latency = {}
+    try:
+        for value in args.latency:
+            command, _, seconds = value.rpartition("=")
+            if command:
+                command_latency[command] = float(seconds)
+            else:
+                latency = float(seconds)
+        stops = [parse_stop(value) for value in args.stop]
+    except ValueError as e:
+        parser.error(str(e))
+    dsp = FakeCamillaDSP(
+        latency=latency,
+        command_latency=command_latency,
+        startup_delay=args.startup_delay,
+        stops=stops,
+        repeat_stops=args.repeat_stops,
+        reject_rates=args.reject_rate,
+        min_chunksize=args.min_chunksize,
+    )
+    return args, dsp
+
+
+if __name__ == "__main__":
+    args, dsp = parse_args()
+    try:
+        asyncio.run(serve(dsp, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,344 @@
+"""
+Switch performance benchmarks for the controller.
+Runs CamillaController against a ScriptedListener and the fake CamillaDSP server,
+so no audio hardware and no real CamillaDSP is needed.
+The results are written as json, for comparing versions.
+
+Usage: python benchmarks/run_benchmarks.py [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import contextlib
+from os.path import dirname, abspath, join
+
+BENCH_DIR = dirname(abspath(__file__))
+REPO_DIR = dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import yaml
+
+from controller import CamillaController, SpecificConfigs
+from datastructures import WaveFormat
+from scripted_listener import ScriptedListener
+
+RATES = (44100, 48000, 88200, 96000, 176400, 192000)
+
+
+class BenchController(CamillaController):
+    """
+    A controller that records when each config was sent to CamillaDSP.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.started = []
+        self.polls = 0
+        super().__init__(*args, **kwargs)
+
+    def update_dsp_state(self, state):
+        self.polls += 1
+        super().update_dsp_state(state)
+
+    def start_cdsp(self):
+        super().start_cdsp()
+        if self.awaiting_running:
+            self.started.append(
+                (time.monotonic(), self.config.config["devices"]["samplerate"])
+            )
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_dsp(port, dsp_args=()):
+    process = subprocess.Popen(
+        [sys.executable, join(BENCH_DIR, "fake_camilladsp.py"), "-p", str(port), *dsp_args]
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("localhost", port), timeout=0.1):
+                return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("The fake CamillaDSP did not start")
+
+
+def write_configs(directory):
+    for rate in RATES:
+        config = {
+            "devices": {
+                "samplerate": rate,
+                "chunksize": 1024,
+                "capture": {"type": "Stdin", "channels": 2, "format": "S32LE"},
+                "playback": {"type": "Stdout", "channels": 2, "format": "S32LE"},
+            }
+        }
+        with open(join(directory, f"bench_{rate}.yml"), "w") as f:
+            yaml.safe_dump(config, f)
+    return join(directory, "bench_{samplerate}.yml")
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for the controller")
+        time.sleep(0.0005)
+
+
+def summary_ms(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean_ms": 1000 * statistics.mean(values),
+        "median_ms": 1000 * statistics.median(values),
+        "p95_ms": 1000 * values[int(0.95 * (len(values) - 1))],
+        "max_ms": 1000 * values[-1],
+    }
+
+
+def bench_switch_latency(controller, listener, switches):
+    """
+    Time from the device event until the new config is sent,
+    and until CamillaDSP reports that it is running.
+    """
+    to_set_active = []
+    for n in range(switches):
+        rate = RATES[(n + 1) % len(RATES)]
+        done = controller.metrics.switches
+        nbr_started = len(controller.started)
+        event_time = listener.switch_to(
+            WaveFormat(sample_rate=rate, sample_format="S32LE", channels=2)
+        )
+        wait_for(lambda: len(controller.started) > nbr_started, 5)
+        to_set_active.append(controller.started[-1][0] - event_time)
+        wait_for(lambda: controller.metrics.switches > done, 5)
+    return {
+        "event_to_set_active": summary_ms(to_set_active),
+        "metrics": controller.metrics.dump(),
+    }
+
+
+def bench_event_storm(controller, listener, switches):
+    """
+    Emit a burst of switches as fast as possible,
+    and measure how long it takes until the final format is active.
+    """
+    # The final rate is not used earlier in the burst,
+    # so that the end is reached when a config with this rate has been sent.
+    # It must also differ from the active rate, since switching to that is a no-op.
+    final_rate = RATES[-1]
+    if len(controller.started) > 0 and controller.started[-1][1] == final_rate:
+        final_rate = RATES[-2]
+    burst_rates = [rate for rate in RATES if rate != final_rate]
+    nbr_started = len(controller.started)
+    start = time.monotonic()
+    for n in range(switches - 1):
+        rate = burst_rates[n % len(burst_rates)]
+        listener.switch_to(WaveFormat(sample_rate=rate, sample_format="S32LE", channels=2))
+    listener.switch_to(
+        WaveFormat(sample_rate=final_rate, sample_format="S32LE", channels=2)
+    )
+    wait_for(
+        lambda: len(controller.started) > nbr_started
+        and controller.started[-1][1] == final_rate,
+        30,
+    )
+    elapsed = time.monotonic() - start
+    events = 2 * switches
+    return {
+        "events": events,
+        "elapsed_s": elapsed,
+        "events_per_second": events / elapsed,
+    }
+
+
+def bench_recovery(controller, duration):
+    """
+    With scripted stops in the fake CamillaDSP, count how often the controller
+    restarts it, and the time between restarts, during the given duration.
+    """
+    nbr_started = len(controller.started)
+    time.sleep(duration)
+    starts = [start for start, _rate in controller.started[nbr_started:]]
+    intervals = [b - a for a, b in zip(starts, starts[1:])]
+    return {
+        "duration_s": duration,
+        "restarts": len(starts),
+        "interval": summary_ms(intervals) if len(intervals) > 0 else None,
+    }
+
+
+def rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def bench_idle(controller, duration):
+    """
+    CPU time and status polls used by the controller process while idle, scaled to one hour.
+    """
+    rss_start = rss_kb()
+    polls_start = controller.polls
+    times_start = os.times()
+    time.sleep(duration)
+    times_end = os.times()
+    polls = controller.polls - polls_start
+    cpu = (times_end.user - times_start.user) + (times_end.system - times_start.system)
+    rss_end = rss_kb()
+    return {
+        "duration_s": duration,
+        "cpu_s_per_hour": cpu * 3600 / duration,
+        "polls_per_second": polls / duration,
+        "rss_kb": rss_end,
+        "rss_growth_kb_per_hour": (
+            (rss_end - rss_start) * 3600 / duration
+            if rss_start is not None and rss_end is not None
+            else None
+        ),
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Controller switch benchmarks")
+    parser.add_argument("--output", help="File to write the results to, default is stdout")
+    parser.add_argument("--switches", help="Number of timed switches", type=int, default=50)
+    parser.add_argument(
+        "--storm", help="Number of switches in the event storm", type=int, default=2000
+    )
+    parser.add_argument(
+        "--idle", help="Duration in seconds of the idle measurement", type=float, default=10
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument(
+        "--idle-poll-interval",
+        help="Longest poll interval, default is the same as --poll-interval",
+        type=float,
+    )
+    parser.add_argument(
+        "--dsp-latency",
+        help="Delay in seconds before the fake CamillaDSP replies to a command",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--dsp-startup-delay",
+        help="Time in seconds from a new config until the fake CamillaDSP is running",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--dsp-stop",
+        help="Scripted stop for the fake CamillaDSP, as AFTER:REASON[:VALUE], repeated after each start. "
+        "Only the recovery benchmark is run when this is given.",
+        action="append",
+    )
+    parser.add_argument(
+        "--recovery", help="Duration in seconds of the recovery benchmark", type=float, default=10
+    )
+    parser.add_argument("--asyncio", help="Run the controller in asyncio mode", action="store_true")
+    parser.add_argument("--verbose", help="Show the controller output", action="store_true")
+    return parser.parse_args()
+
+
+def run(args):
+    port = free_port()
+    dsp_args = [
+        "--latency",
+        str(args.dsp_latency),
+        "--startup-delay",
+        str(args.dsp_startup_delay),
+    ]
+    if args.dsp_stop is not None:
+        for stop in args.dsp_stop:
+            dsp_args += ["--stop", stop]
+        dsp_args.append("--repeat-stops")
+    dsp = start_fake_dsp(port, dsp_args)
+    try:
+        with tempfile.TemporaryDirectory() as config_dir:
+            template = write_configs(config_dir)
+            listener = ScriptedListener()
+            providers = [SpecificConfigs(template, RATES[0], None, None)]
+            controller = BenchController(
+                "localhost",
+                port,
+                providers,
+                listener,
+                poll_interval=args.poll_interval,
+                idle_poll_interval=args.idle_poll_interval,
+            )
+            target = controller.run_async if args.asyncio else controller.run
+            threading.Thread(target=target, daemon=True).start()
+            # Let the controller do the initial start
+            wait_for(lambda: len(controller.started) > 0, 5)
+            results = {
+                "version": git_version(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "mode": "asyncio" if args.asyncio else "sync",
+                "poll_interval_s": args.poll_interval,
+                "idle_poll_interval_s": controller.idle_poll_interval,
+                "dsp_latency_s": args.dsp_latency,
+                "dsp_startup_delay_s": args.dsp_startup_delay,
+            }
+            if args.dsp_stop is not None:
+                results["dsp_stops"] = args.dsp_stop
+                results["recovery"] = bench_recovery(controller, args.recovery)
+                return results
+            time.sleep(2 * args.poll_interval + args.dsp_startup_delay)
+            results["switch_latency"] = bench_switch_latency(controller, listener, args.switches)
+            results["event_storm"] = bench_event_storm(controller, listener, args.storm)
+            results["idle"] = bench_idle(controller, args.idle)
+            return results
+    finally:
+        dsp.terminate()
+        dsp.wait()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.verbose:
+        results = run(args)
+    else:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
@@ -0,0 +1,62 @@
+import time
+
+from datastructures import WaveFormat, DeviceEvent, ListenerEvent
+from device_listener import DeviceListener
+
+
+class ScriptedListener(DeviceListener):
+    """
+    A device listener that emits events on request, instead of listening to a real device.
+    Used for benchmarking the controller without any audio hardware.
+    """
+
+    def __init__(self, initial_format=None):
+        self.on_change = None
+        if initial_format is None:
+            initial_format = WaveFormat(
+                sample_rate=44100, sample_format="S32LE", channels=2
+            )
+        self.wave_format = initial_format
+
+    def set_on_change(self, function):
+        self.on_change = function
+
+    def read_wave_format(self):
+        return self.wave_format
+
+    def emit_event(self, kind, wakeup_time, wave_format=None):
+        if self.metrics is not None:
+            self.metrics.start_switch(wakeup_time)
+        if self.on_change is not None:
+            self.on_change(ListenerEvent(kind, wave_format, "scripted", wakeup_time))
+
+    def switch_to(self, wave_format):
+        """
+        Simulate a change of wave format, by emitting a stop and a start event.
+        Returns the monotonic time when the change happened.
+        """
+        wakeup_time = time.monotonic()
+        self.wave_format = wave_format
+        self.emit_event(DeviceEvent.STOPPED, wakeup_time)
+        self.emit_event(DeviceEvent.STARTED, wakeup_time, wave_format)
+        return wakeup_time
+
+    def stop(self):
+        """
+        Simulate the device being stopped.
+        """
+        wakeup_time = time.monotonic()
+        self.emit_event(DeviceEvent.STOPPED, wakeup_time)
+        return wakeup_time
+
+    def play_script(self, script):
+        """
+        Play a script, given as a list of (delay in seconds, WaveFormat) tuples.
+        A WaveFormat of None means that the device is stopped.
+        """
+        for delay, wave_format in script:
+            time.sleep(delay)
+            if wave_format is None:
+                self.stop()
+            else:
+                self.switch_to(wave_format)
@@ -1,16 +1,15 @@
-import cffi
+import time
 
-from datastructures import WaveFormat, DeviceEvent
+from datastructures import WaveFormat, DeviceEvent, ListenerEvent
 from device_listener import DeviceListener
 
+# The bindings are compiled at install time, by running ca_listener_build.py
 try:
     from _ca_listener import ffi, lib
-except ImportError:
-    print("Compiling bindings, this will only be done on the first run.")
-    import ca_listener_build
-
-    ca_listener_build.run_build()
-    from _ca_listener import ffi, lib
+except ImportError as e:
+    raise ImportError(
+        "The CoreAudio bindings are not built, run 'python ca_listener_build.py' first"
+    ) from e
 
 
 def to_int(bytes):
@@ -109,9 +108,13 @@ class CAListener(DeviceListener):
         self.listening = True
         print("Listening...")
 
-    def emit_event(self, event):
+    def emit_event(self, kind, wave_format=None, wakeup_time=None):
+        if self.metrics is not None and wakeup_time is not None:
+            self.metrics.start_switch(wakeup_time)
+        if wakeup_time is None:
+            wakeup_time = time.monotonic()
         if self.on_change is not None:
-            self.on_change(event)
+            self.on_change(ListenerEvent(kind, wave_format, self.device_name, wakeup_time))
 
     def stop(self):
         if not self.listening:
@@ -140,13 +143,11 @@ class CAListener(DeviceListener):
 
 @ffi.def_extern()
 def property_listener(inObjectID, _inNumberAddresses, _inAddresses, inClientData):
+    wakeup_time = time.monotonic()
     self = ffi.from_handle(inClientData)
     wave_format = self.read_wave_format()
-    stop_event = DeviceEvent.STOPPED
-    self.emit_event(stop_event)
-    start_event = DeviceEvent.STARTED
-    start_event.set_data(wave_format)
-    self.emit_event(start_event)
+    self.emit_event(DeviceEvent.STOPPED, wakeup_time=wakeup_time)
+    self.emit_event(DeviceEvent.STARTED, wave_format)
     return 0
 
 
@@ -156,7 +157,7 @@ def demo(device):
     listener = CAListener(device)
 
     def dummy_callback(params):
-        print(params, params.data)
+        print(params)
 
     print(listener.read_wave_format())
     listener.set_on_change(dummy_callback)
@@ -0,0 +1,86 @@
+import os
+import sys
+import marshal
+import hashlib
+import tempfile
+from os.path import abspath, join
+
+
+def default_cache_dir():
+    """
+    Return the default directory for the parsed config cache.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or join(os.path.expanduser("~"), ".cache")
+    return join(base, "camilladsp-controller")
+
+
+class ParsedConfigCache:
+    """
+    An on-disk cache of parsed config files, stored with marshal.
+    There is one cache file per config file, named by a hash of the absolute path.
+    An entry is only used if the path, modification time, size and inode
+    of the config file are unchanged, and it was written by the same Python version.
+    The cache is best effort, any error reading or writing it is treated as a miss.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_file(self, path):
+        digest = hashlib.sha1(path.encode()).hexdigest()
+        return join(self.directory, digest + ".marshal")
+
+    @staticmethod
+    def _signature(path, stat):
+        return (
+            path,
+            stat.st_mtime_ns,
+            stat.st_size,
+            stat.st_ino,
+            sys.version_info[:2],
+        )
+
+    def get(self, filename):
+        """
+        Return the cached parsed config for a file, or None if there is no valid entry.
+        """
+        path = abspath(filename)
+        try:
+            signature = self._signature(path, os.stat(path))
+            with open(self._cache_file(path), "rb") as f:
+                cached_signature, config = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            self.misses += 1
+            return None
+        if cached_signature != signature:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return config
+
+    def put(self, filename, config, stat):
+        """
+        Store a parsed config, given the stat of the file before it was read.
+        Nothing is stored if the file changed while it was being read,
+        or if the config contains values that marshal can't store.
+        """
+        path = abspath(filename)
+        try:
+            signature = self._signature(path, stat)
+            if self._signature(path, os.stat(path)) != signature:
+                return
+            data = marshal.dumps((signature, config))
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file and rename, so that readers never see a partial entry
+            fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_name, self._cache_file(path))
+            except BaseException:
+                os.unlink(tmp_name)
+                raise
+        except (OSError, ValueError) as e:
+            print(f"Unable to cache parsed config {filename}, error: {e}")
@@ -1,131 +1,549 @@
 import time
-from copy import deepcopy
-import yaml
+import json
+import signal
+import threading
+from collections import OrderedDict
+import re
+import os
+import glob
 import argparse
 import platform
-from os.path import isfile
+import tempfile
+from os.path import isfile, dirname
 
+import websocket
 from camilladsp import CamillaClient, ProcessingState, StopReason, CamillaError
 
-from datastructures import DeviceEvent
+from datastructures import DeviceEvent, WaveFormat, ListenerEvent, PreparedConfig, ConfigUpdate
+from metrics import SwitchMetrics
+from event_queue import EventQueue
+from state_machine import ControllerState, Action, DspState
+from config_cache import ParsedConfigCache, default_cache_dir
+from event_trace import TraceRecorder
 
-if platform.system() == "Linux":
-    from alsa_listener import AlsaControlListener
-if platform.system() == "Darwin":
-    from ca_listener import CAListener
-
-RUNNING_STATES = (
-    ProcessingState.RUNNING,
-    ProcessingState.PAUSED,
-    ProcessingState.STALLED,
-    ProcessingState.STARTING,
-)
+# Modules that are only needed by some modes, providers or listeners
+# are imported where they are used, to keep the startup fast.
 
+DEFAULT_IDLE_POLL_INTERVAL = 2.0
 
 class CamillaController:
 
-    def __init__(self, host, port, config_providers, listener):
+    def __init__(
+        self,
+        host,
+        port,
+        config_providers,
+        listener,
+        poll_interval=0.2,
+        idle_poll_interval=None,
+        poll_backoff=2.0,
+        coalesce_window=0.0,
+        reconnect_min_delay=0.01,
+        reconnect_max_delay=1.0,
+        validate_workers=0,
+        watch_configs=False,
+        trace_size=4096,
+        status_socket=None,
+        latency_tuner=None,
+        connect=True,
+    ):
+        """
+        With 'connect', the connection to CamillaDSP is made here, and blocks until it succeeds.
+        Otherwise it is made by main_loop_async(), so that several controllers can wait
+        for their CamillaDSP instances in the same event loop.
+        """
         self.listener = listener
         self.host = host
         self.port = port
         self.config_providers = config_providers
-        self.events = []
+        # Poll every 'poll_interval' after a command or a state change,
+        # then back off by 'poll_backoff' per steady poll, up to 'idle_poll_interval'.
+        self.poll_interval = poll_interval
+        if idle_poll_interval is None:
+            idle_poll_interval = poll_interval
+        self.idle_poll_interval = max(idle_poll_interval, poll_interval)
+        self.poll_backoff = poll_backoff
+        self.current_poll_interval = poll_interval
+        self.last_polled_state = None
+        self.poll_wakeup = None
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.events = EventQueue(coalesce_window=coalesce_window)
+        # Only used in asyncio mode, see run_async()
+        self.loop = None
+        self.events_available = None
+        self.command_lock = None
+        self.command_generation = 0
+        self.metrics = SwitchMetrics()
+        # Chooses the chunksize from the CamillaDSP telemetry, or None to use the configs as they are
+        self.tuner = latency_tuner
+        # Recent events, commands and state changes, for dumping on request
+        self.trace = TraceRecorder(trace_size)
+        self.last_stop_reason = None
+        self.awaiting_running = False
         self.cdsp = CamillaClient(self.host, self.port)
-        self.cdsp.connect()
+        self.connected = False
         if self.listener is not None:
+            self.listener.set_metrics(self.metrics)
             self.listener.set_on_change(self.queue_event)
             self.listener.run()
-        self.expected_running = None
-        self.error_on_start = False
+        # The known and desired state of CamillaDSP
+        self.state = ControllerState()
+        # Validation results, keyed by config digest. Empty when validation is not enabled.
+        self.validation = {}
+        self.validate_workers = validate_workers
+        if connect:
+            self.connect()
+        # The arguments of the last config lookup, repeated when a config file changes
+        self.lookup_args = {}
+        self.config_provider = None
+        self.status_server = None
+        if status_socket is not None:
+            from status_server import StatusServer
+
+            self.status_server = StatusServer(status_socket, self.queue_event)
+            self.status_server.run()
         self.get_config_for_new_wave_format()
+        self.publish_status()
+        self.watcher = None
+        if watch_configs:
+            self.watch_config_files()
 
     def queue_event(self, params):
-        self.events.append(params)
-
-    def debounce_event_queue(self):
-        # If the queue contains a stop event, remove any start and stop events before this
-        events_to_remove = []
-        stop_found = False
-        # Iterate through the list from the end
-        for n, event in enumerate(reversed(self.events)):
-            if not stop_found and event == DeviceEvent.STOPPED:
-                # This is the first stop event we encounter
-                stop_found = True
-            elif stop_found and event in (DeviceEvent.STARTED, DeviceEvent.STOPPED):
-                # This start or stop event is followed by a stop, mark it for removal
-                events_to_remove.append(n)
-        orig_len = len(self.events)
-        for rev_idx in events_to_remove:
-            idx = orig_len - rev_idx - 1
-            # the indexes are sorted in decreasing order, safe to just pop
-            self.events.pop(idx)
+        # Called from the listener thread, wake up the main loop immediately
+        if isinstance(params, ListenerEvent):
+            # Only device events are part of a switch
+            self.metrics.mark("queue")
+            self.trace.record_event(params)
+        self.events.put(params)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.events_available.set)
+
+    def take_events(self, timeout, wait_for_window=True):
+        """
+        Wait up to 'timeout' seconds for device events,
+        then return all queued events (coalesced) and clear the queue.
+        """
+        return self.events.take(timeout, wait_for_window=wait_for_window)
 
     def main_loop(self):
+        next_poll = time.monotonic()
         while True:
-            time.sleep(0.2)
+            # Sleep until an event arrives or it is time to poll CamillaDSP
+            events = self.take_events(next_poll - time.monotonic())
 
             # Handle any change events from the device
-            if len(self.events) > 1:
-                self.debounce_event_queue()
-            while len(self.events) > 0:
-                event = self.events.pop(0)
-                # handle each event
-                print(event)
-                if event == DeviceEvent.STARTED:
-                    wave_format = event.data
-                    # re-read wave format here!
-                    if self.listener is not None:
-                        wave_format = listener.read_wave_format()
-                    print("Device started with wave format", wave_format)
-                    self.get_config_for_new_wave_format(
-                        sample_rate=wave_format.sample_rate,
-                        sample_format=wave_format.sample_format,
-                        channels=wave_format.channels,
-                    )
-                    self.stop_cdsp()
-                    self.start_cdsp()
-                elif event == DeviceEvent.STOPPED:
-                    print("Device stopped")
-                    self.stop_cdsp()
-
-            # Query CamillaDSP for status
-            state = self.cdsp.general.state()
-            if state == ProcessingState.INACTIVE:
-                # print("CamillaDSP is inactive")
-                stop_reason = self.cdsp.general.stop_reason()
-                if stop_reason == StopReason.CAPTUREFORMATCHANGE:
-                    if not self.error_on_start:
-                        print("CamillaDSP stopped because the capture format changed")
-                        new_rate = stop_reason.data
-                        # re-read wave format here!
-                        if self.listener is not None:
-                            wave_format = listener.read_wave_format()
-                            print("Updated", wave_format)
-                            if wave_format.sample_rate is not None:
-                                new_rate = wave_format.sample_rate
-                        if new_rate > 0:
-                            self.get_config_for_new_wave_format(sample_rate=new_rate)
-                            self.stop_cdsp()
-                            self.start_cdsp()
-                        else:
-                            print(
-                                "Sample rate changed, new value is unknown. Unable to get get a new config"
-                            )
-                elif stop_reason == StopReason.DONE:
-                    print("Capture is done, no action")
-                elif stop_reason == StopReason.NONE:
-                    # print("Initial start")
-                    if not self.error_on_start:
-                        self.start_cdsp()
-                elif stop_reason in (
-                    StopReason.CAPTUREERROR,
-                    StopReason.PLAYBACKERROR,
-                ):
-                    if not self.error_on_start:
-                        print("Stopped due to error, trying to restart", stop_reason)
-                        self.start_cdsp()
-                elif stop_reason == StopReason.PLAYBACKFORMATCHANGE:
-                    print("Playback format changed, ")
+            for event in events:
+                self.run_supervised(self.handle_event, event, retry=True)
+                self.poll_soon()
+                next_poll = min(next_poll, time.monotonic() + self.poll_interval)
+
+            if time.monotonic() >= next_poll:
+                self.run_supervised(self.poll_cdsp_state)
+                next_poll = time.monotonic() + self.next_poll_interval()
+
+    def poll_soon(self):
+        """
+        Go back to the fast poll interval, to follow the state changes after a command.
+        """
+        self.current_poll_interval = self.poll_interval
+        if self.poll_wakeup is not None:
+            self.poll_wakeup.set()
+
+    def next_poll_interval(self):
+        """
+        Return the time to wait until the next status poll.
+        The interval grows while the state is steady.
+        """
+        interval = self.current_poll_interval
+        self.current_poll_interval = min(
+            interval * self.poll_backoff, self.idle_poll_interval
+        )
+        return interval
+
+    def connect(self):
+        """
+        Connect to CamillaDSP, and validate the candidate configs if requested.
+        """
+        self.connect_with_backoff(self.cdsp)
+        self.connected = True
+        if self.validate_workers > 0:
+            self.validate_candidates(self.validate_workers)
+
+    def connect_with_backoff(self, client):
+        """
+        Connect a client to CamillaDSP.
+        The first attempt is made immediately.
+        If it fails, keep trying with an increasing delay, up to 'reconnect_max_delay'.
+        """
+        delay = self.reconnect_min_delay
+        while True:
+            try:
+                client.connect()
+                return
+            except Exception as e:
+                print(f"Unable to connect to CamillaDSP, retrying in {delay} s, error: {e}")
+                time.sleep(delay)
+                delay = min(2 * delay, self.reconnect_max_delay)
+
+    def run_supervised(self, function, *args, retry=False):
+        """
+        Run a function that sends commands to CamillaDSP.
+        If the connection is lost, reconnect and restore the desired state.
+        With 'retry', the function is run again after reconnecting,
+        instead of restoring the state.
+        The state is read from CamillaDSP after reconnecting,
+        so that only the commands needed to restore it are sent.
+        The restore is supervised too, and is repeated if the connection is lost again.
+        """
+        reconnected = False
+        while True:
+            try:
+                if reconnected:
+                    self.check_dsp_after_reconnect()
+                    reconnected = False
+                function(*args)
+                return
+            except OSError as e:
+                # The client raises IOError when the connection is lost
+                print("Lost connection to CamillaDSP:", e)
+                lost = time.monotonic()
+                self.connect_with_backoff(self.cdsp)
+                outage = time.monotonic() - lost
+                self.metrics.record_reconnect(lost)
+                print(f"Reconnected to CamillaDSP after {1000 * outage:.1f} ms")
+                # CamillaDSP may have been restarted, its state is unknown until it is read
+                self.state.connection_lost()
+                reconnected = True
+                if not retry:
+                    print("Restoring the desired state")
+                    function, args = self.apply_state, ()
+
+    def check_dsp_after_reconnect(self):
+        """
+        Read the state of CamillaDSP after reconnecting.
+        If it is running with other devices than the active config, for example after being
+        restarted with a config file, the active config is forgotten so that it is restarted.
+        Otherwise the active config is sent again as a reload, see ControllerState.plan().
+        """
+        state = self.cdsp.general.state()
+        self.update_dsp_state(state)
+        if self.state.dsp_state == DspState.RUNNING and self.state.active_config is not None:
+            running = PreparedConfig(json.loads(self.cdsp.query("GetConfigJson")))
+            if running_devices(running) != running_devices(self.state.active_config):
+                print("CamillaDSP is running another config")
+                self.state.forget_config()
+
+    def apply_state(self):
+        """
+        Send the commands needed to bring CamillaDSP to the desired state with the current config.
+        Returns the list of actions that were taken.
+        """
+        actions = self.state.plan(self.config)
+        if len(actions) == 0:
+            self.metrics.cancel_switch()
+        else:
+            self.current_poll_interval = self.poll_interval
+        for action in actions:
+            if action == Action.STOP:
+                self.stop_cdsp()
+            elif action == Action.START:
+                self.start_cdsp()
+            elif action == Action.RELOAD:
+                print("Updating the config without restarting CamillaDSP")
+                self.start_cdsp()
+        self.publish_status()
+        return actions
+
+    def status(self):
+        """
+        Return the state known by the controller, as a dictionary.
+        """
+        stop_reason = None
+        if self.last_stop_reason is not None:
+            stop_reason = {
+                "reason": self.last_stop_reason.name,
+                "data": self.last_stop_reason.data,
+            }
+        return {
+            "wave_format": self.lookup_args,
+            "provider": self.config_provider,
+            "config": devices_summary(self.config),
+            "dsp_state": self.last_polled_state.name if self.last_polled_state else None,
+            "controller_state": self.state.dsp_state.name,
+            "desired_running": self.state.desired_running,
+            "stop_reason": stop_reason,
+            "chunksizes": self.tuner.as_dict() if self.tuner is not None else None,
+            "switches": self.metrics.dump(),
+        }
+
+    def publish_status(self):
+        """
+        Send the current status to the subscribers of the status server, if there is one.
+        """
+        if self.status_server is not None:
+            self.status_server.publish(self.status())
+
+    def handle_event(self, event):
+        print(event)
+        self.metrics.mark("dequeue")
+        if isinstance(event, ConfigUpdate):
+            event.provider.apply_changes(event.update)
+            # Look up the config again, it is only sent if the active config changed
+            self.get_config_for_new_wave_format(**self.lookup_args)
+            if not self.apply_state():
+                print("The active config is not affected")
+        elif event.kind == DeviceEvent.STARTED:
+            if event.device == "api" or not self.metrics.in_progress():
+                # The listener did not start the switch,
+                # or it is left from an earlier device event
+                self.metrics.start_switch(event.timestamp)
+            # The event carries the format that was read when the change was detected
+            wave_format = event.wave_format
+            print("Device started with wave format", wave_format)
+            self.get_config_for_new_wave_format(
+                sample_rate=wave_format.sample_rate,
+                sample_format=wave_format.sample_format,
+                channels=wave_format.channels,
+                allow_step_down=True,
+            )
+            self.state.desired_running = True
+            if not self.apply_state():
+                print("CamillaDSP is already running this config")
+        elif event.kind == DeviceEvent.STOPPED:
+            print("Device stopped")
+            self.state.desired_running = False
+            if not self.apply_state():
+                print("CamillaDSP is already stopped")
+            # A stop is not a switch, don't let it count as the start of the next one
+            self.metrics.cancel_switch()
+
+    def watch_config_files(self):
+        """
+        Watch the directories of the config files for changes, using inotify.
+        Changed files are parsed by the watcher thread,
+        and the results are applied by the main loop.
+        """
+        from inotify_watcher import InotifyWatcher
+
+        try:
+            self.watcher = InotifyWatcher(self.config_files_changed)
+            for provider in self.config_providers:
+                for directory in provider.watched_directories():
+                    self.watcher.add_directory(directory)
+                provider.watched = True
+        except OSError as e:
+            print("Unable to watch the config files, error:", e)
+            for provider in self.config_providers:
+                provider.watched = False
+            self.watcher = None
+            return
+        self.watcher.run()
+
+    def config_files_changed(self, paths):
+        # Called from the watcher thread
+        for provider in self.config_providers:
+            update = provider.parse_changed(paths)
+            if update:
+                print(f"Config files changed for {provider.name} provider")
+                self.queue_event(ConfigUpdate(provider, update))
+
+    def poll_cdsp_state(self):
+        # Query CamillaDSP for status
+        state = self.cdsp.general.state()
+        self.update_dsp_state(state)
+        if state == ProcessingState.INACTIVE:
+            # print("CamillaDSP is inactive")
+            stop_reason = self.cdsp.general.stop_reason()
+            self.handle_stop_reason(stop_reason)
+        elif state == ProcessingState.RUNNING and self.tuner is not None:
+            buffer_level = self.cdsp.status.buffer_level()
+            rate_adjust = self.cdsp.status.rate_adjust()
+            if self.observe_telemetry(buffer_level, rate_adjust):
+                self.retune()
+
+    def tuning_params(self):
+        """
+        Return the sample rate and chunksize of the current config, for the latency tuner.
+        """
+        if self.config is None:
+            return None, None
+        devices = self.config.config.get("devices", {})
+        return devices.get("samplerate"), devices.get("chunksize")
+
+    def running_chunksize(self, sample_rate):
+        """
+        Return the chunksize CamillaDSP is running with, if it is running at the given rate.
+        """
+        config = self.state.active_config
+        if self.state.dsp_state != DspState.RUNNING or config is None:
+            return None
+        devices = config.config.get("devices", {})
+        if devices.get("samplerate") != sample_rate:
+            return None
+        return devices.get("chunksize")
+
+    def observe_telemetry(self, buffer_level, rate_adjust):
+        """
+        Give a telemetry sample to the latency tuner.
+        Returns True if the chunksize for the current rate must be changed at once.
+        """
+        rate, chunksize = self.tuning_params()
+        if rate is None:
+            return False
+        return self.tuner.observe(rate, buffer_level, rate_adjust, chunksize)
+
+    def retune(self):
+        """
+        Apply a new chunksize chosen by the latency tuner.
+        """
+        self.get_config_for_new_wave_format(**self.lookup_args)
+        self.apply_state()
+
+    def update_dsp_state(self, state):
+        self.state.observe(state)
+        changed = state != self.last_polled_state
+        if changed or self.awaiting_running:
+            if changed:
+                self.trace.record_state(state.name)
+                self.last_stop_reason = None
+            # Keep polling fast while CamillaDSP is in transition
+            self.last_polled_state = state
+            self.current_poll_interval = self.poll_interval
+        # Ends the switch timing when CamillaDSP is running after a start
+        if self.awaiting_running and state == ProcessingState.RUNNING:
+            self.awaiting_running = False
+            self.metrics.mark("running")
+            self.metrics.finish_switch()
+            changed = True
+        if changed:
+            self.publish_status()
+
+    def handle_stop_reason(self, stop_reason):
+        new_reason = stop_reason != self.last_stop_reason
+        if new_reason:
+            self.trace.record_state(ProcessingState.INACTIVE.name, stop_reason.name)
+            self.last_stop_reason = stop_reason
+            self.publish_status()
+        if stop_reason == StopReason.CAPTUREFORMATCHANGE:
+            print("CamillaDSP stopped because the capture format changed")
+            self.metrics.start_switch()
+            new_rate = stop_reason.data
+            # re-read wave format here!
+            if self.listener is not None:
+                wave_format = self.listener.read_wave_format()
+                print("Updated", wave_format)
+                if wave_format.sample_rate is not None:
+                    new_rate = wave_format.sample_rate
+            if new_rate > 0:
+                self.get_config_for_new_wave_format(sample_rate=new_rate, allow_step_down=True)
+                self.apply_state()
+            else:
+                print(
+                    "Sample rate changed, new value is unknown. Unable to get get a new config"
+                )
+        elif stop_reason == StopReason.DONE:
+            print("Capture is done, no action")
+        elif stop_reason == StopReason.NONE:
+            # Initial start, or stopped by us
+            self.apply_state()
+        elif stop_reason in (
+            StopReason.CAPTUREERROR,
+            StopReason.PLAYBACKERROR,
+        ):
+            if self.state.desired_running:
+                print("Stopped due to error, trying to restart", stop_reason)
+            rate, chunksize = self.tuning_params()
+            if self.tuner is not None and new_reason and rate is not None:
+                if self.tuner.record_error(rate, chunksize):
+                    self.get_config_for_new_wave_format(**self.lookup_args)
+            self.apply_state()
+        elif stop_reason == StopReason.PLAYBACKFORMATCHANGE:
+            print("Playback format changed, ")
+
+    def validate_candidates(self, workers):
+        """
+        Validate all configs the providers can supply, using CamillaDSP's validation.
+        The configs are validated concurrently, using one connection per worker thread.
+        Configs that fail validation are skipped when switching.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        # digest -> (payload, provider name)
+        candidates = {}
+        for provider in self.config_providers:
+            for prepared in provider.candidate_configs():
+                candidates.setdefault(prepared.digest, (prepared.payload, provider.name))
+        print(f"Validating {len(candidates)} configs")
+
+        local = threading.local()
+        clients = []
+
+        def validate(digest):
+            client = getattr(local, "client", None)
+            if client is None:
+                client = CamillaClient(self.host, self.port)
+                self.connect_with_backoff(client)
+                local.client = client
+                clients.append(client)
+            payload, provider_name = candidates[digest]
+            try:
+                client.query("ValidateConfig", arg=payload)
+                return True
+            except CamillaError as e:
+                print(f"Invalid config from {provider_name} provider, error: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            verdicts = list(executor.map(validate, candidates))
+        for client in clients:
+            client.disconnect()
+        self.validation.update(zip(candidates, verdicts))
+        print(f"{sum(verdicts)} of {len(verdicts)} configs are valid")
+
+    def is_known_invalid(self, prepared):
+        """
+        Return True if a config has failed validation.
+        """
+        # Skip computing the digest when validation is not enabled
+        return bool(self.validation) and self.validation.get(prepared.digest) is False
+
+    def validate_tuned(self, prepared):
+        """
+        Validate a config with a chunksize chosen by the latency tuner,
+        since only the configs as supplied by the providers are validated at startup.
+        The result is remembered. Returns True when validation is not enabled.
+        """
+        if not self.validation:
+            return True
+        verdict = self.validation.get(prepared.digest)
+        if verdict is None:
+            try:
+                self.cdsp.query("ValidateConfig", arg=prepared.payload)
+                verdict = True
+            except CamillaError as e:
+                print("Invalid config with tuned chunksize, error:", e)
+                verdict = False
+            self.validation[prepared.digest] = verdict
+        return verdict
+
+    def dump_metrics(self, filename=None):
+        """
+        Write the switch metrics as json to the given file, or print them if no file is given.
+        """
+        metrics = json.dumps(self.metrics.dump())
+        if filename is None:
+            print(metrics)
+        else:
+            with open(filename, "w") as f:
+                f.write(metrics)
+
+    def dump_trace(self, filename):
+        """
+        Write the recorded trace to the given file.
+        """
+        count = self.trace.dump(filename)
+        print(f"Wrote {count} trace records to {filename}")
 
     def run(self):
         try:
@@ -133,24 +551,148 @@ class CamillaController:
         except KeyboardInterrupt:
             print("Shutting down...")
 
+    async def main_loop_async(self):
+        """
+        Asyncio version of main_loop.
+        Device events and status polling are handled by separate tasks.
+        The blocking CamillaDSP commands are run in worker threads,
+        so that a slow command never stalls the intake of new events.
+        Status polling uses its own websocket connection and can overlap with commands.
+        """
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        self.events_available = asyncio.Event()
+        self.command_lock = asyncio.Lock()
+        self.poll_wakeup = asyncio.Event()
+        # Handle any events that were queued before the loop started
+        self.events_available.set()
+        if not self.connected:
+            await asyncio.to_thread(self.connect)
+            if self.validation:
+                # The config was looked up before validating, look it up again
+                await asyncio.to_thread(self.get_config_for_new_wave_format, **self.lookup_args)
+        status_cdsp = CamillaClient(self.host, self.port)
+        await asyncio.to_thread(self.connect_with_backoff, status_cdsp)
+        poll_task = asyncio.create_task(self.poll_loop_supervised_async(status_cdsp))
+        try:
+            while True:
+                await self.events_available.wait()
+                if self.events.coalesce_window > 0:
+                    await asyncio.sleep(self.events.coalesce_window)
+                self.events_available.clear()
+                # Events that arrive while a command is running are queued,
+                # and coalesced together once the command is done.
+                for event in self.take_events(0, wait_for_window=False):
+                    await self.run_command_async(self.handle_event, event, retry=True)
+                    self.poll_soon()
+        finally:
+            poll_task.cancel()
+            self.loop = None
+            self.poll_wakeup = None
+            await asyncio.to_thread(status_cdsp.disconnect)
+
+    async def poll_loop_supervised_async(self, status_cdsp):
+        """
+        Run the status polling, and restart it after an unexpected error.
+        Without polling, stops caused by errors would never be noticed.
+        """
+        import asyncio
+        import traceback
+
+        while True:
+            try:
+                await self.poll_loop_async(status_cdsp)
+            except Exception:
+                print("Status polling failed, restarting it")
+                traceback.print_exc()
+                await asyncio.sleep(self.poll_interval)
+
+    async def poll_loop_async(self, status_cdsp):
+        import asyncio
+
+        while True:
+            generation = self.command_generation
+            telemetry = None
+            try:
+                state = await asyncio.to_thread(status_cdsp.general.state)
+                if state == ProcessingState.INACTIVE:
+                    stop_reason = await asyncio.to_thread(status_cdsp.general.stop_reason)
+                elif state == ProcessingState.RUNNING and self.tuner is not None:
+                    telemetry = (
+                        await asyncio.to_thread(status_cdsp.status.buffer_level),
+                        await asyncio.to_thread(status_cdsp.status.rate_adjust),
+                    )
+            except OSError as e:
+                print("Lost status connection to CamillaDSP:", e)
+                await asyncio.to_thread(self.connect_with_backoff, status_cdsp)
+                continue
+            # Skip the result if a command was run, or is running, while it was being read,
+            # the state it describes is already outdated.
+            current = generation == self.command_generation and not self.command_lock.locked()
+            if current:
+                self.update_dsp_state(state)
+            if state == ProcessingState.INACTIVE:
+                if current:
+                    await self.run_command_async(
+                        self.handle_stop_reason, stop_reason, generation=generation
+                    )
+            elif telemetry is not None and current:
+                if self.observe_telemetry(*telemetry):
+                    await self.run_command_async(self.retune, generation=generation)
+            # Sleep until the next poll, or until a command asks for a fast poll
+            self.poll_wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    self.poll_wakeup.wait(), self.next_poll_interval()
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_command_async(self, function, *args, generation=None, retry=False):
+        import asyncio
+
+        async with self.command_lock:
+            if generation is not None and generation != self.command_generation:
+                return
+            # Bump the generation both before and after,
+            # to invalidate any status query that overlaps with the command.
+            self.command_generation += 1
+            await asyncio.to_thread(self.run_supervised, function, *args, retry=retry)
+            self.command_generation += 1
+
+    def run_async(self):
+        import asyncio
+
+        try:
+            asyncio.run(self.main_loop_async())
+        except KeyboardInterrupt:
+            print("Shutting down...")
+
     def stop_cdsp(self):
         print("Stopping CamillaDSP")
+        self.trace.record_command("Stop")
         self.cdsp.general.stop()
-        self.expected_running = False
-        self.error_on_start = False
+        self.state.stopped()
+        self.metrics.mark("stop")
+        self.awaiting_running = False
 
     def start_cdsp(self):
         if self.config is not None:
             print("Starting CamillaDSP with new config")
+            self.trace.record_command("SetConfigJson", devices_summary(self.config))
             try:
-                self.cdsp.config.set_active(self.config)
-                self.expected_running = True
-                self.error_on_start = False
+                # Send the pre-serialized config, equivalent to config.set_active()
+                self.cdsp.query("SetConfigJson", arg=self.config.payload)
+                self.state.started(self.config)
+                self.metrics.mark("set_active")
+                self.awaiting_running = True
                 print("Started")
             except CamillaError as e:
                 print("Unable to start, error:", e)
-                self.expected_running = True
-                self.error_on_start = True
+                self.trace.record_command("Error", str(e))
+                self.state.start_failed(self.config)
+                self.metrics.cancel_switch()
         else:
             print("No config available, ignoring start request")
 
@@ -158,11 +700,21 @@ class CamillaController:
         #    print("No new config is available, not starting")
 
     def get_config_for_new_wave_format(
-        self, sample_rate=None, sample_format=None, channels=None
+        self, sample_rate=None, sample_format=None, channels=None, allow_step_down=False
     ):
+        """
+        Look up the config for a wave format, and apply the chunksize chosen by the latency tuner.
+        A smaller chunksize is only used with 'allow_step_down', when the device has started
+        or changed format, otherwise the running chunksize is kept.
+        """
         print(
             f"Getting new config for rate: {sample_rate}, format: {sample_format}, channels: {channels}"
         )
+        self.lookup_args = {
+            "sample_rate": sample_rate,
+            "sample_format": sample_format,
+            "channels": channels,
+        }
         for provider in self.config_providers:
             try:
                 provider.change_wave_format(
@@ -170,18 +722,65 @@ class CamillaController:
                     sample_format=sample_format,
                     channels=channels,
                 )
-                self.config = provider.get_config()
+                self.config = provider.get_prepared_config()
+                if self.config is not None and self.is_known_invalid(self.config):
+                    print(f"Config from {provider.name} provider is known to be invalid, skipping")
+                    self.config = None
+                    continue
                 if self.config is not None:
                     print(f"Using new config from {provider.name} provider")
-                    return
+                    self.config_provider = provider.name
+                    break
             except Exception as e:
                 print(
                     f"Provider {provider.name} is unable to supply a new config for this wave format"
                 )
-        print(
-            f"No config available for rate: {sample_rate}, format: {sample_format}, channels: {channels}"
-        )
-        self.config = None
+        else:
+            print(
+                f"No config available for rate: {sample_rate}, format: {sample_format}, channels: {channels}"
+            )
+            self.config = None
+            self.config_provider = None
+            return
+        # Outside of the provider error handling, a lost connection must reach run_supervised
+        if self.tuner is not None:
+            min_chunksize = None
+            if not allow_step_down:
+                min_chunksize = self.running_chunksize(
+                    self.config.config.get("devices", {}).get("samplerate")
+                )
+            tuned = self.tuner.apply(self.config, min_chunksize=min_chunksize)
+            if tuned is self.config or self.validate_tuned(tuned):
+                self.config = tuned
+            else:
+                print("The config is invalid with the tuned chunksize, using it unchanged")
+        self.metrics.mark("config_lookup")
+
+
+def running_devices(config):
+    """
+    Return the device settings of a PreparedConfig that CamillaDSP reports without defaults added,
+    for comparing the config CamillaDSP runs with the one sent to it.
+    """
+    summary = devices_summary(config)
+    summary["chunksize"] = config.config.get("devices", {}).get("chunksize")
+    return summary
+
+
+def devices_summary(config):
+    """
+    Return the sample rate, capture format and capture channels of a PreparedConfig,
+    or None if there is no config.
+    """
+    if config is None:
+        return None
+    devices = config.config.get("devices", {})
+    capture = devices.get("capture", {})
+    return {
+        "samplerate": devices.get("samplerate"),
+        "format": capture.get("format"),
+        "channels": capture.get("channels"),
+    }
 
 
 class CamillaConfig:
@@ -190,9 +789,21 @@ class CamillaConfig:
     """
 
     name = "base class for config provider"
+    prepared_cache_size = 16
+    # Defaults for providers that don't call CamillaConfig.__init__
+    config = None
+    # Created on first use by prepare()
+    prepared = None
+    # A ParsedConfigCache, or None to always parse the files
+    parsed_cache = None
+    # True when the files are watched for changes, then they don't need to be checked
+    watched = False
 
-    def __init__(self):
+    def __init__(self, parsed_cache=None):
         self.config = None
+        self.prepared = OrderedDict()
+        self.parsed_cache = parsed_cache
+        self.watched = False
 
     def get_config(self):
         """
@@ -201,13 +812,87 @@ class CamillaConfig:
         """
         return self.config
 
+    def get_prepared_config(self):
+        """
+        Return the current config as a PreparedConfig, or None if no config can be provided.
+        The PreparedConfig is reused for as long as get_config() returns the same object,
+        so that a config is only serialized once.
+        """
+        config = self.get_config()
+        if config is None:
+            return None
+        return self.prepare(config)
+
+    def prepare(self, config):
+        """
+        Return a PreparedConfig for the given config, reusing a cached one if available.
+        """
+        # The cached PreparedConfig keeps a reference to its config,
+        # so the id can't be reused by another object while it is in the cache.
+        if self.prepared is None:
+            self.prepared = OrderedDict()
+        prepared = self.prepared.get(id(config))
+        if prepared is None:
+            prepared = PreparedConfig(config)
+            self.prepared[id(config)] = prepared
+            if len(self.prepared) > self.prepared_cache_size:
+                self.prepared.popitem(last=False)
+        else:
+            self.prepared.move_to_end(id(config))
+        return prepared
+
+    def candidate_configs(self):
+        """
+        Return a list of PreparedConfig for all the configs this provider can supply.
+        Used for validating the configs at startup.
+        This method should be overriden in the child class.
+        """
+        return []
+
+    def watched_directories(self):
+        """
+        Return the directories containing the config files of this provider,
+        to be watched for changes.
+        This method should be overriden in the child class.
+        """
+        return []
+
+    def parse_changed(self, paths):
+        """
+        Parse the config files among the given changed paths that are used by this provider.
+        Called from the watcher thread, so it must not modify the provider.
+        Returns a dictionary of the changes to pass to apply_changes(),
+        or an empty dictionary if none of the files are used.
+        This method should be overriden in the child class.
+        """
+        return {}
+
+    def apply_changes(self, update):
+        """
+        Apply the changes returned by parse_changed().
+        This method should be overriden in the child class.
+        """
+        pass
+
     def read_config(self, filename):
         """
-        Helper method to read and parse a yaml file
+        Helper method to read and parse a yaml file.
+        Uses the parsed config cache if there is one,
+        and the libyaml based loader if available.
         """
+        if self.parsed_cache is not None:
+            config = self.parsed_cache.get(filename)
+            if config is not None:
+                return config
+        import yaml
+
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        stat = os.stat(filename)
         with open(filename) as f:
-            config = yaml.safe_load(f)
-            return config
+            config = yaml.load(f, Loader=loader)
+        if self.parsed_cache is not None:
+            self.parsed_cache.put(filename, config, stat)
+        return config
 
     def change_wave_format(self, sample_rate=None, sample_format=None, channels=None):
         """
@@ -230,13 +915,23 @@ class AdaptConfig(CamillaConfig):
     Modify a single config file for different wave formats.
     If the config has resampling, change only 'capture_samplerate', and disable resamplng if it's not needed.
     If no resampler, change 'samplerate'.
+    The adapted configs are cached, and only the parts that are modified are copied.
+    The rest is shared with the base config, and must not be modified.
     """
 
     name = "Adapt"
 
-    def __init__(self, config_path):
+    def __init__(self, config_path, cache_size=16, precompute_rates=None, parsed_cache=None):
+        super().__init__(parsed_cache=parsed_cache)
+        self.config_path = config_path
         self.base_config = self.read_config(config_path)
         self.config = self.base_config
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        if precompute_rates is not None:
+            for rate in precompute_rates:
+                self.change_wave_format(sample_rate=rate)
+            self.config = self.base_config
 
     def _change_sample_rate(self, config, rate):
         if config["devices"].get("resampler") is None:
@@ -265,9 +960,51 @@ class AdaptConfig(CamillaConfig):
     def _change_channels(self, config, channels):
         raise NotImplementedError("Changing channels is not implemented")
 
+    def candidate_configs(self):
+        # The base config, and the variants prepared at startup or used since
+        configs = [self.base_config] + list(self.cache.values())
+        return [self.prepare(config) for config in configs]
+
+    def watched_directories(self):
+        return [dirname(self.config_path) or os.curdir]
+
+    def parse_changed(self, paths):
+        base_path = os.path.abspath(self.config_path)
+        if not any(os.path.abspath(path) == base_path for path in paths):
+            return {}
+        if not self.check_if_exists(self.config_path):
+            print(f"Config file {self.config_path} was removed, keeping the loaded config")
+            return {}
+        try:
+            return {"base_config": self.read_config(self.config_path)}
+        except Exception as e:
+            print(f"Unable to read config file {self.config_path}, error: {e}")
+            return {}
+
+    def apply_changes(self, update):
+        print(f"Config file {self.config_path} was modified, adapting it again")
+        self.base_config = update["base_config"]
+        self.config = self.base_config
+        # The adapted configs are made from the old base config
+        self.cache.clear()
+
+    def _copy_devices(self, config):
+        # Copy only the parts of the config that the _change_* methods modify
+        config = dict(config)
+        config["devices"] = dict(config["devices"])
+        config["devices"]["capture"] = dict(config["devices"]["capture"])
+        return config
+
     def change_wave_format(self, sample_rate=None, sample_format=None, channels=None):
-        # adjust base_config and store as self.config
-        config = deepcopy(self.base_config)
+        key = WaveFormat(sample_rate, sample_format, channels)
+        config = self.cache.get(key)
+        if config is not None:
+            print("Using cached config for", key)
+            self.cache.move_to_end(key)
+            self.config = config
+            return
+        # adjust a copy of base_config and store as self.config
+        config = self._copy_devices(self.base_config)
         # handle rate
         if sample_rate is not None:
             self._change_sample_rate(config, sample_rate)
@@ -275,20 +1012,35 @@ class AdaptConfig(CamillaConfig):
             self._change_sample_format(config, sample_format)
         if channels is not None:
             self._change_channels(config, channels)
+        self.cache[key] = config
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
         self.config = config
 
 
-
 class SpecificConfigs(CamillaConfig):
     """
     Load separate config files for different rates.
     The file path is generated by subsituting the tokens
     {sampleformat}, {channels} and {samplerate} with their current values.
     Example: test_{sampleformat}_{channels}_{samplerate}.yml => test_S16LE_2_44100.yml
+    All files matching the template are read and parsed at startup,
+    and kept in memory indexed by (samplerate, sampleformat, channels).
+    A cached config is re-read when the modification time of its file changes,
+    and the index is rebuilt when a file is added to or removed from one of the directories.
     """
     name = "Specific"
 
-    def __init__(self, config_path, initial_rate, initial_format, initial_channels):
+    tokens = {
+        "samplerate": r"\d+",
+        "sampleformat": r"\w+",
+        "channels": r"\d+",
+    }
+
+    def __init__(
+        self, config_path, initial_rate, initial_format, initial_channels, parsed_cache=None
+    ):
+        super().__init__(parsed_cache=parsed_cache)
         self.config_path = config_path
         self.rate = initial_rate
         self.format = initial_format
@@ -302,10 +1054,132 @@ class SpecificConfigs(CamillaConfig):
             missing.append("channels")
         if len(missing) > 0:
             raise ValueError(f"Missing initial values for {', '.join(missing)}")
+        self.pattern = self._template_regex()
+        # key -> (filename, mtime, parsed config), or None for a known missing variant
+        self.index = {}
+        self.dir_mtimes = {}
+        self.scan()
+        self.config = self._lookup()
+
+    def _template_regex(self):
+        regex = re.escape(self.config_path)
+        for token, token_regex in self.tokens.items():
+            escaped = re.escape("{" + token + "}")
+            # Capture the first occurrence, any repetitions must have the same value
+            regex = regex.replace(escaped, f"(?P<{token}>{token_regex})", 1)
+            regex = regex.replace(escaped, f"(?P={token})")
+        return re.compile(regex + "$")
+
+    def _key(self, rate, fmt, channels):
+        # Only the tokens used by the template are part of the key
+        return (
+            str(rate) if "{samplerate}" in self.config_path else None,
+            fmt if "{sampleformat}" in self.config_path else None,
+            str(channels) if "{channels}" in self.config_path else None,
+        )
+
+    def _directories(self):
+        pattern = self.config_path
+        for token in self.tokens:
+            pattern = pattern.replace("{" + token + "}", "*")
+        return pattern, set(glob.glob(dirname(pattern) or "."))
+
+    def scan(self):
+        """
+        Find and parse all config files matching the template.
+        """
+        self.index = {}
+        pattern, directories = self._directories()
+        self.dir_mtimes = {}
+        for directory in directories:
+            self.dir_mtimes[directory] = os.stat(directory).st_mtime_ns
+        for filename in glob.glob(pattern):
+            match = self.pattern.match(filename)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            key = self._key(
+                groups.get("samplerate"), groups.get("sampleformat"), groups.get("channels")
+            )
+            try:
+                self.index[key] = self._load(filename)
+            except Exception as e:
+                print(f"Unable to read config file {filename}, error: {e}")
+        print(f"Found {len(self.index)} config files matching {self.config_path}")
+
+    def candidate_configs(self):
+        return [
+            self.prepare(entry[2]) for entry in self.index.values() if entry is not None
+        ]
+
+    def watched_directories(self):
+        return sorted(self._directories()[1])
+
+    def parse_changed(self, paths):
+        update = {}
+        for path in paths:
+            match = self.pattern.match(path)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            key = self._key(
+                groups.get("samplerate"), groups.get("sampleformat"), groups.get("channels")
+            )
+            if not self.check_if_exists(path):
+                update[key] = None
+                continue
+            try:
+                update[key] = self._load(path)
+            except Exception as e:
+                print(f"Unable to read config file {path}, error: {e}")
+        return update
+
+    def apply_changes(self, update):
+        for key, entry in update.items():
+            if entry is None:
+                print("Config file was removed for", key)
+            else:
+                print("Config file was modified:", entry[0])
+        self.index.update(update)
+
+    def _load(self, filename):
+        mtime = os.stat(filename).st_mtime_ns
+        return filename, mtime, self.read_config(filename)
+
+    def _directories_changed(self):
+        for path, mtime in self.dir_mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def _lookup(self):
+        key = self._key(self.rate, self.format, self.channels)
+        if self.watched:
+            # The index is kept up to date by apply_changes()
+            entry = self.index.get(key)
+            return entry[2] if entry is not None else None
+        if self._directories_changed():
+            print("Config files were added or removed, updating index")
+            self.scan()
+        entry = self.index.get(key)
+        if entry is None:
+            # Remember that this variant is missing
+            self.index[key] = None
+            return None
+        filename, mtime, config = entry
         try:
-            self.config = self.read_config(self._filename())
+            if os.stat(filename).st_mtime_ns != mtime:
+                print(f"Config file {filename} was modified, reading it again")
+                entry = self._load(filename)
+                self.index[key] = entry
+                filename, mtime, config = entry
         except FileNotFoundError:
-            self.config = None
+            self.index[key] = None
+            return None
+        return config
 
     def _filename(self):
         name = self.config_path
@@ -324,14 +1198,35 @@ class SpecificConfigs(CamillaConfig):
             self.format = sample_format
         if channels is not None:
             self.channels = channels
-        print("New config path:", self._filename())
-        self.config = self.read_config(self._filename())
+        self.config = self._lookup()
+        if self.config is None:
+            print("No config file for:", self._filename())
+        else:
+            print("New config path:", self._filename())
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="CamillaDSP controller")
     if platform.system() in ("Linux", "Darwin"):
         parser.add_argument("-d", "--device", help="Name of capture device to monitor")
+    if platform.system() == "Linux":
+        parser.add_argument(
+            "--adaptive-settle",
+            help="Read the device controls as soon as they are stable, instead of after a fixed delay",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--settle-quiet-time",
+            help="Time in seconds the controls must be stable in adaptive mode",
+            type=float,
+            default=0.01,
+        )
+        parser.add_argument(
+            "--settle-max-time",
+            help="Maximum time in seconds to wait for the controls to settle in adaptive mode",
+            type=float,
+            default=0.1,
+        )
     parser.add_argument(
         "-s",
         "--specific",
@@ -348,26 +1243,209 @@ def parse_args():
     #     "--custom",
     #     help="Argument for a custom config provider",
     # )
+    parser.add_argument("-p", "--port", help="CamillaDSP websocket port", type=int)
+    parser.add_argument("--host", help="CamillaDSP websocket host", default="localhost")
     parser.add_argument(
-        "-p", "--port", help="CamillaDSP websocket port", type=int, required=True
+        "--adapt-rates",
+        help="Comma separated list of sample rates to prepare adapted configs for at startup",
     )
-    parser.add_argument("--host", help="CamillaDSP websocket host", default="localhost")
     parser.add_argument("-f", "--format", help="Initial value for sample format")
     parser.add_argument("-c", "--channels", help="Initial value for number of channels")
     parser.add_argument("-r", "--rate", help="Initial value for sample rate")
+    parser.add_argument(
+        "--poll-interval",
+        help="Interval in seconds between CamillaDSP status queries after a command or state change",
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument(
+        "--idle-poll-interval",
+        help="Longest interval in seconds between CamillaDSP status queries, reached when the state is steady. "
+        f"Default: {DEFAULT_IDLE_POLL_INTERVAL} with a device listener, otherwise the poll interval. "
+        "The restart after a capture or playback error may be delayed by up to this time",
+        type=float,
+    )
+    parser.add_argument(
+        "--poll-backoff",
+        help="Factor to increase the status query interval by for each poll that finds no change",
+        type=float,
+        default=2.0,
+    )
+    parser.add_argument(
+        "--coalesce-window",
+        help="Time in seconds to wait for more events after a device event, before acting on the final state",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--reconnect-max-delay",
+        help="Maximum delay in seconds between attempts to reconnect to CamillaDSP",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--command-timeout",
+        help="Timeout in seconds for CamillaDSP commands, a connection that does not respond is reconnected",
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--validate",
+        help="Validate all configs at startup, using this number of concurrent connections",
+        type=int,
+        default=0,
+        metavar="WORKERS",
+    )
+    parser.add_argument(
+        "--config-cache-dir",
+        help="Directory for caching parsed config files between runs",
+        default=default_cache_dir(),
+    )
+    parser.add_argument(
+        "--no-config-cache",
+        help="Always parse the config files, without using the cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-watch",
+        help="Don't watch the config files for changes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace-size",
+        help="Number of events, commands and state changes to keep in the trace buffer",
+        type=int,
+        default=4096,
+    )
+    parser.add_argument(
+        "--trace-file",
+        help="File to write the trace buffer to on SIGUSR2",
+        default=os.path.join(tempfile.gettempdir(), "camilladsp-controller-trace.jsonl"),
+    )
+    parser.add_argument(
+        "--replay",
+        help="Replay the device events of a trace file, instead of listening to a device",
+        metavar="TRACE_FILE",
+    )
+    parser.add_argument(
+        "--replay-fast",
+        help="Replay the trace as fast as possible, instead of in real time",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--status-socket",
+        help="Serve the status on this Unix socket, and accept switch and stop commands",
+    )
+    parser.add_argument(
+        "--latency-tiers",
+        help="Comma separated list of chunksizes. When given, the chunksize for each sample rate "
+        "is chosen from these, based on the buffer level, rate adjust and errors reported by CamillaDSP",
+    )
+    parser.add_argument(
+        "--latency-stable-time",
+        help="Time in seconds without problems before moving to a smaller chunksize",
+        type=float,
+        default=300.0,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="File to write switch timing metrics to on SIGUSR1, default is to print them",
+    )
+    parser.add_argument(
+        "--asyncio",
+        help="Run the controller in asyncio mode",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-i",
+        "--instances",
+        help="Config file defining several CamillaDSP instances to control from this process",
+    )
 
     args = parser.parse_args()
 
-    if args.specific is None and args.adapt is None:
-        parser.error("At least one of '--specific' and '--adapt' must be provided")
+    if args.instances is None:
+        if args.port is None:
+            parser.error("The '--port' argument is required")
+        if args.specific is None and args.adapt is None:
+            parser.error("At least one of '--specific' and '--adapt' must be provided")
 
     return parser, args
 
 
+def read_instances(parser, args):
+    """
+    Read the instances config file, and return a dictionary of instance name and arguments.
+    The arguments are given as a Namespace, with the same fields as the command line arguments.
+    Example file:
+    instances:
+      main:
+        device: "hw:Loopback,0,0"
+        port: 1234
+        specific: "/path/to/main_{samplerate}.yml"
+        rate: 44100
+      gadget:
+        device: "hw:UAC2Gadget"
+        host: localhost
+        port: 1235
+        adapt: "/path/to/gadget.yml"
+        adapt_rates: [44100, 48000]
+    """
+    import yaml
+
+    try:
+        with open(args.instances) as f:
+            instances = yaml.safe_load(f)["instances"]
+    except Exception as e:
+        parser.error(f"Unable to read instances from {args.instances}, error: {e}")
+    instance_args = {}
+    # device -> name of the instance using it
+    devices = {}
+    for name, instance in instances.items():
+        if instance.get("port") is None:
+            parser.error(f"Instance '{name}' has no port")
+        device = instance.get("device")
+        if device is not None:
+            # A listener sends its events to a single controller
+            if device in devices:
+                parser.error(f"Instances '{devices[device]}' and '{name}' use the same device {device}")
+            devices[device] = name
+        if instance.get("specific") is None and instance.get("adapt") is None:
+            parser.error(f"Instance '{name}' needs at least one of 'specific' and 'adapt'")
+        adapt_rates = instance.get("adapt_rates")
+        if isinstance(adapt_rates, list):
+            adapt_rates = ",".join(str(rate) for rate in adapt_rates)
+        instance_args[name] = argparse.Namespace(
+            device=instance.get("device"),
+            host=instance.get("host", "localhost"),
+            port=int(instance["port"]),
+            specific=instance.get("specific"),
+            adapt=instance.get("adapt"),
+            adapt_rates=adapt_rates,
+            rate=instance.get("rate"),
+            format=instance.get("format"),
+            channels=instance.get("channels"),
+        )
+    return instance_args
+
+
 def get_listener(args):
-    if platform.system() == "Linux" and args.device is not None:
-        listener = AlsaControlListener(args.device)
-    if platform.system() == "Darwin" and args.device is not None:
+    if args.replay is not None:
+        from replay_listener import ReplayListener
+
+        listener = ReplayListener(args.replay, realtime=not args.replay_fast)
+    elif platform.system() == "Linux" and args.device is not None:
+        from alsa_listener import AlsaControlListener
+
+        listener = AlsaControlListener(
+            args.device,
+            adaptive=args.adaptive_settle,
+            quiet_time=args.settle_quiet_time,
+            max_settle_time=args.settle_max_time,
+        )
+    elif platform.system() == "Darwin" and args.device is not None:
+        from ca_listener import CAListener
+
         listener = CAListener(args.device)
     else:
         listener = None
@@ -375,7 +1453,60 @@ def get_listener(args):
     return listener
 
 
-def get_config_providers(parser, args, wave_format=None):
+def get_instance_listeners(args, devices):
+    """
+    Return a dictionary of device name and listener.
+    On Linux, all devices are watched by a single polling thread.
+    """
+    if platform.system() == "Linux":
+        from alsa_listener import MultiAlsaControlListener
+
+        multi_listener = MultiAlsaControlListener(
+            devices,
+            adaptive=args.adaptive_settle,
+            quiet_time=args.settle_quiet_time,
+            max_settle_time=args.settle_max_time,
+        )
+        return {device: multi_listener.listener(device) for device in devices}
+    if platform.system() == "Darwin":
+        from ca_listener import CAListener
+
+        return {device: CAListener(device) for device in devices}
+    return {device: None for device in devices}
+
+
+def get_idle_poll_interval(args, listener):
+    """
+    Return the idle poll interval.
+    Without a listener, the polls are the only way to notice that the capture format changed,
+    so they don't back off unless asked to.
+    """
+    if args.idle_poll_interval is not None:
+        return args.idle_poll_interval
+    if listener is None:
+        return args.poll_interval
+    return DEFAULT_IDLE_POLL_INTERVAL
+
+
+def get_latency_tuner(parser, args):
+    if args.latency_tiers is None:
+        return None
+    from latency_tuner import LatencyTuner
+
+    try:
+        tiers = [int(size) for size in args.latency_tiers.split(",")]
+    except ValueError as e:
+        parser.error(f"Invalid latency tiers: {e}")
+    return LatencyTuner(tiers, stable_time=args.latency_stable_time)
+
+
+def get_parsed_cache(args):
+    if args.no_config_cache:
+        return None
+    return ParsedConfigCache(args.config_cache_dir)
+
+
+def get_config_providers(parser, args, wave_format=None, parsed_cache=None):
     configs = []
     sample_rate = args.rate
     sample_format = args.format
@@ -399,33 +1530,144 @@ def get_config_providers(parser, args, wave_format=None):
     if args.specific is not None:
         try:
             config = SpecificConfigs(
-                args.specific, sample_rate, sample_format, channels
+                args.specific, sample_rate, sample_format, channels, parsed_cache=parsed_cache
             )
             configs.append(config)
         except Exception as e:
             parser.error(str(e))
     if args.adapt is not None:
         try:
-            config = AdaptConfig(args.adapt)
+            precompute_rates = None
+            if args.adapt_rates is not None:
+                precompute_rates = [int(rate) for rate in args.adapt_rates.split(",")]
+            config = AdaptConfig(
+                args.adapt, precompute_rates=precompute_rates, parsed_cache=parsed_cache
+            )
             configs.append(config)
         except Exception as e:
             parser.error(str(e))
     return configs
 
 
+def create_controller(parser, args, host, port, configs, listener, status_socket, connect=True):
+    """
+    Create a CamillaController with the options given on the command line.
+    """
+    return CamillaController(
+        host,
+        port,
+        configs,
+        listener,
+        poll_interval=args.poll_interval,
+        idle_poll_interval=get_idle_poll_interval(args, listener),
+        poll_backoff=args.poll_backoff,
+        coalesce_window=args.coalesce_window,
+        reconnect_max_delay=args.reconnect_max_delay,
+        validate_workers=args.validate,
+        watch_configs=not args.no_watch,
+        trace_size=args.trace_size,
+        status_socket=status_socket,
+        latency_tuner=get_latency_tuner(parser, args),
+        connect=connect,
+    )
+
+
+def run_instances(parser, args):
+    """
+    Control several CamillaDSP instances from a single process.
+    The device listeners share a single polling thread,
+    and all controllers run in asyncio mode in the same event loop.
+    """
+    import asyncio
+
+    websocket.setdefaulttimeout(args.command_timeout)
+    instances = read_instances(parser, args)
+    devices = set(
+        instance.device for instance in instances.values() if instance.device is not None
+    )
+    listeners = get_instance_listeners(args, devices)
+    parsed_cache = get_parsed_cache(args)
+
+    controllers = {}
+    for name, instance in instances.items():
+        listener = listeners.get(instance.device)
+        wave_format = listener.read_wave_format() if listener is not None else None
+        configs = get_config_providers(
+            parser, instance, wave_format=wave_format, parsed_cache=parsed_cache
+        )
+        print(f"Starting controller for instance '{name}'")
+        status_socket = None
+        if args.status_socket is not None:
+            status_socket = f"{args.status_socket}.{name}"
+        controllers[name] = create_controller(
+            parser, args, instance.host, instance.port, configs, listener, status_socket, connect=False
+        )
+
+    def dump_metrics(_signum, _frame):
+        metrics = json.dumps(
+            {name: controller.metrics.dump() for name, controller in controllers.items()}
+        )
+        if args.metrics_file is None:
+            print(metrics)
+        else:
+            with open(args.metrics_file, "w") as f:
+                f.write(metrics)
+
+    def dump_traces(_signum, _frame):
+        for name, controller in controllers.items():
+            controller.dump_trace(f"{args.trace_file}.{name}")
+
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, dump_metrics)
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, dump_traces)
+
+    async def main_loops():
+        await asyncio.gather(
+            *(controller.main_loop_async() for controller in controllers.values())
+        )
+
+    try:
+        asyncio.run(main_loops())
+    except KeyboardInterrupt:
+        print("Shutting down...")
+
+
 if __name__ == "__main__":
     parser, args = parse_args()
 
-    listener = get_listener(args)
-
-    if listener is not None:
-        # Try to get the current wave format
-        wave_format = listener.read_wave_format()
-        print(wave_format)
+    if args.instances is not None:
+        run_instances(parser, args)
     else:
-        wave_format = None
+        websocket.setdefaulttimeout(args.command_timeout)
+        listener = get_listener(args)
 
-    configs = get_config_providers(parser, args, wave_format=wave_format)
+        if listener is not None:
+            # Try to get the current wave format
+            wave_format = listener.read_wave_format()
+            print(wave_format)
+        else:
+            wave_format = None
 
-    controller = CamillaController(args.host, args.port, configs, listener)
-    controller.run()
+        configs = get_config_providers(
+            parser, args, wave_format=wave_format, parsed_cache=get_parsed_cache(args)
+        )
+
+        controller = create_controller(
+            parser, args, args.host, args.port, configs, listener, args.status_socket
+        )
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(
+                signal.SIGUSR1,
+                lambda _signum, _frame: controller.dump_metrics(args.metrics_file),
+            )
+        if hasattr(signal, "SIGUSR2"):
+            signal.signal(
+                signal.SIGUSR2,
+                lambda _signum, _frame: controller.dump_trace(args.trace_file),
+            )
+
+        if args.asyncio:
+            controller.run_async()
+        else:
+            controller.run()
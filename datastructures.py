@@ -1,5 +1,8 @@
+import json
+import hashlib
+import time
 from enum import Enum, auto
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 class DeviceEvent(Enum):
     """
@@ -8,32 +11,71 @@ class DeviceEvent(Enum):
     STOPPED = auto()
     STARTED = auto()
 
-    def __new__(cls, value):
-        obj = object.__new__(cls)
-        obj._value_ = value
-        obj._data = None
-        return obj
 
-    def set_data(self, value):
-        """
-        Set the custom data property of the enum.
-        """
-        self._data = value
-
-    @property
-    def data(self):
-        """
-        Getter for the data property
-        """
-        return self._data
-
-
-@dataclass
+@dataclass(frozen=True, slots=True)
 class WaveFormat:
     """
     A class representing a wave format, that consists of the sample rate,
     sample format and number of channels.
+    It is immutable and hashable, and can be used as a dictionary key.
     """
     sample_rate: int | None
     sample_format: str | None
-    channels: int | None
\ No newline at end of file
+    channels: int | None
+
+
+@dataclass(frozen=True, slots=True)
+class ListenerEvent:
+    """
+    An event sent by a device listener.
+    It carries its own data, so that events can be queued without being overwritten.
+    The timestamp is from time.monotonic(), taken when the change was detected.
+    """
+    kind: DeviceEvent
+    wave_format: WaveFormat | None = None
+    device: str | None = None
+    timestamp: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class ConfigUpdate:
+    """
+    Config files that were changed on disk and parsed again,
+    to be applied to the provider that uses them.
+    The content of 'update' is specific to the provider.
+    """
+    provider: object
+    update: dict = field(repr=False)
+
+
+class PreparedConfig:
+    """
+    A CamillaDSP config together with its serialized form,
+    as sent to CamillaDSP by the SetConfigJson command.
+    The config is serialized on first use, and the result is kept for reuse.
+    The config must not be modified after it has been serialized.
+    """
+    __slots__ = ("config", "_payload", "_digest")
+
+    def __init__(self, config):
+        self.config = config
+        self._payload = None
+        self._digest = None
+
+    @property
+    def payload(self):
+        """
+        Getter for the serialized config
+        """
+        if self._payload is None:
+            self._payload = json.dumps(self.config)
+        return self._payload
+
+    @property
+    def digest(self):
+        """
+        Getter for a short hash of the serialized config, for use as a key
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.payload.encode()).hexdigest()
+        return self._digest
@@ -5,6 +5,8 @@ class DeviceListener:
     A base class for a device listener
     """
 
+    metrics = None
+
     def __init__(self, device):
         pass
 
@@ -18,10 +20,16 @@ class DeviceListener:
     def set_on_change(self, function):
         """
         Provide a callback function that gets called when some event occurs.
-        The callback is called once per event, and will be called with a DeviceEvent as argument.
+        The callback is called once per event, and will be called with a ListenerEvent as argument.
         """
         pass
 
+    def set_metrics(self, metrics):
+        """
+        Provide a SwitchMetrics object for recording the timing of the listener stages.
+        """
+        self.metrics = metrics
+
     def read_wave_format(self):
         """
         Read and return the current values.
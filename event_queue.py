@@ -0,0 +1,60 @@
+import time
+import threading
+from collections import deque
+
+from datastructures import ListenerEvent
+
+
+class EventQueue:
+    """
+    A thread safe queue for device events.
+    Events are added by the listener thread with put(),
+    and taken all at once by the controller with take().
+    A burst of STOPPED and STARTED events is coalesced into the final event,
+    that represents the final state of the device.
+    This is done when an event is added, so at most one device event is queued
+    however many arrive. Other events, such as config updates, are never dropped.
+    """
+
+    def __init__(self, coalesce_window=0.0):
+        self.coalesce_window = coalesce_window
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.first_time = None
+        # The queued ListenerEvent, replaced by the next one
+        self.device_event = None
+
+    def __len__(self):
+        return len(self.events)
+
+    def put(self, event):
+        with self.cond:
+            if len(self.events) == 0:
+                self.first_time = time.monotonic()
+            if isinstance(event, ListenerEvent):
+                if self.device_event is not None:
+                    self.events.remove(self.device_event)
+                self.device_event = event
+            self.events.append(event)
+            self.cond.notify()
+
+    def take(self, timeout, wait_for_window=True):
+        """
+        Wait up to 'timeout' seconds for an event.
+        Once an event has arrived, wait until the coalescing window has passed,
+        to collect any further events in the same burst.
+        Return all queued events, coalesced, and clear the queue.
+        """
+        with self.cond:
+            if len(self.events) == 0 and timeout > 0:
+                self.cond.wait(timeout)
+            if len(self.events) > 0 and wait_for_window:
+                deadline = self.first_time + self.coalesce_window
+                remaining = deadline - time.monotonic()
+                while remaining > 0:
+                    self.cond.wait(remaining)
+                    remaining = deadline - time.monotonic()
+            events = list(self.events)
+            self.events.clear()
+            self.device_event = None
+        return events
@@ -0,0 +1,97 @@
+import json
+import time
+import threading
+from collections import deque
+
+from datastructures import DeviceEvent, WaveFormat, ListenerEvent
+
+# Record types
+EVENT = "event"
+COMMAND = "command"
+STATE = "state"
+
+
+class TraceRecorder:
+    """
+    Record listener events, DSP commands and DSP state changes
+    in a bounded in-memory ring buffer.
+    When the buffer is full, the oldest records are dropped.
+    Each record is a list, starting with the time.monotonic() timestamp and the record type:
+    - [timestamp, "event", kind, device, sample_rate, sample_format, channels]
+    - [timestamp, "command", command, detail]
+    - [timestamp, "state", state, stop_reason]
+    The buffer is dumped on demand as json lines, one record per line.
+    """
+
+    def __init__(self, size=4096):
+        self.records = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def record_event(self, event):
+        wave_format = event.wave_format
+        if wave_format is None:
+            wave_format = WaveFormat(None, None, None)
+        self.append(
+            [
+                event.timestamp,
+                EVENT,
+                event.kind.name,
+                event.device,
+                wave_format.sample_rate,
+                wave_format.sample_format,
+                wave_format.channels,
+            ]
+        )
+
+    def record_command(self, command, detail=None):
+        self.append([time.monotonic(), COMMAND, command, detail])
+
+    def record_state(self, state, stop_reason=None):
+        self.append([time.monotonic(), STATE, state, stop_reason])
+
+    def append(self, record):
+        # Records are added from both the listener and the controller threads
+        with self.lock:
+            self.records.append(record)
+
+    def dump(self, filename):
+        """
+        Write the recorded records to a file, oldest first.
+        """
+        with self.lock:
+            records = list(self.records)
+        with open(filename, "w") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")))
+                f.write("\n")
+        return len(records)
+
+
+def load_trace(filename):
+    """
+    Read a trace file, and return the records as a list.
+    """
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def trace_events(records, device=None):
+    """
+    Return the listener events of a trace as ListenerEvent objects,
+    optionally only those from the given device.
+    """
+    events = []
+    for record in records:
+        if record[1] != EVENT:
+            continue
+        timestamp, _, kind, event_device, sample_rate, sample_format, channels = record
+        if device is not None and event_device != device:
+            continue
+        wave_format = None
+        if DeviceEvent[kind] == DeviceEvent.STARTED:
+            wave_format = WaveFormat(sample_rate, sample_format, channels)
+        events.append(ListenerEvent(DeviceEvent[kind], wave_format, event_device, timestamp))
+    return events
@@ -0,0 +1,99 @@
+import os
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from os.path import join
+
+# From linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+# The events that mean that a file in a watched directory has a new content, or is gone.
+# Files that are replaced by a rename, as many editors do, are reported as IN_MOVED_TO.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Watch directories for changed files, using inotify via ctypes.
+    The events are read by a background thread, that blocks until there is an event.
+    Events that arrive within 'settle_time' seconds of each other are collected,
+    and the callback is called once with the set of changed paths.
+    Raises OSError if inotify is not available.
+    """
+
+    def __init__(self, callback, settle_time=0.1):
+        self.callback = callback
+        self.settle_time = settle_time
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # watch descriptor -> directory
+        self.directories = {}
+        self.thread = None
+
+    def add_directory(self, directory):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), ctypes.c_uint32(WATCH_MASK)
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.directories[wd] = directory
+
+    def read_events(self):
+        """
+        Read the pending events, and return the set of changed paths.
+        """
+        data = os.read(self.fd, 65536)
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                print("Too many file change events, some may have been lost")
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or mask & IN_IGNORED or len(name) == 0:
+                continue
+            # Keep relative paths in the same form as the watched directory was given
+            if directory == os.curdir:
+                paths.add(os.fsdecode(name))
+            else:
+                paths.add(join(directory, os.fsdecode(name)))
+        return paths
+
+    def watchloop(self):
+        while True:
+            select.select([self.fd], [], [])
+            paths = self.read_events()
+            # Collect the rest of the events from the same write or rename
+            while select.select([self.fd], [], [], self.settle_time)[0]:
+                paths |= self.read_events()
+            if len(paths) > 0:
+                try:
+                    self.callback(paths)
+                except Exception as e:
+                    print("Error while handling changed files:", e)
+
+    def run(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.watchloop, daemon=True)
+            self.thread.start()
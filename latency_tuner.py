@@ -0,0 +1,196 @@
+import time
+from collections import OrderedDict
+
+from datastructures import PreparedConfig
+
+# Limits the wait before trying a smaller tier again to stable_time * 2**5
+MAX_FAILED_STEP_DOWNS = 5
+
+
+class RateHistory:
+    """
+    The chosen tier and the recent behavior of CamillaDSP at one sample rate.
+    """
+
+    def __init__(self, tier, now):
+        self.tier = tier
+        # Start of the current period without problems
+        self.stable_since = now
+        self.low_buffer_count = 0
+        # Number of times a smaller tier has failed, makes the next attempt wait longer
+        self.failed_step_downs = 0
+        # True from a step down until the smaller tier has been stable for 'stable_time'
+        self.stepped_down = False
+
+
+class LatencyTuner:
+    """
+    Choose the chunksize for each sample rate, from a list of latency tiers,
+    using the buffer level, rate adjust and stop reasons reported by CamillaDSP.
+    Each sample rate starts at the smallest tier that is not smaller than the chunksize of the config.
+    - A capture or playback error moves the rate to the next larger tier at once.
+    - So does a buffer level below 'min_buffer_fraction' of the chunksize
+      in 'low_buffer_samples' consecutive samples.
+    - After 'stable_time' seconds without problems, the rate moves to the next smaller tier.
+      This is not applied at once, to avoid interrupting the audio,
+      but at the next config lookup, when the device starts or changes format.
+      A rate adjust further than 'max_rate_deviation' from 1.0 counts as a problem,
+      it resets the stable period without moving up.
+    - If a smaller tier fails within 'stable_time' of being applied, the stable time needed
+      for the next attempt is doubled, up to MAX_FAILED_STEP_DOWNS times,
+      so that the tiers don't flap.
+    The chunksize given to observe() and record_error() is the one CamillaDSP is running with.
+    All times are from time.monotonic().
+    """
+
+    def __init__(
+        self,
+        tiers,
+        stable_time=300.0,
+        min_buffer_fraction=0.25,
+        low_buffer_samples=3,
+        max_rate_deviation=0.002,
+        cache_size=16,
+    ):
+        self.tiers = sorted(tiers)
+        self.stable_time = stable_time
+        self.min_buffer_fraction = min_buffer_fraction
+        self.low_buffer_samples = low_buffer_samples
+        self.max_rate_deviation = max_rate_deviation
+        self.rates = {}
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def _tier_for(self, chunksize):
+        for n, size in enumerate(self.tiers):
+            if chunksize is None or size >= chunksize:
+                return n
+        return len(self.tiers) - 1
+
+    def _history(self, rate, chunksize, now):
+        history = self.rates.get(rate)
+        if history is None:
+            history = RateHistory(self._tier_for(chunksize), now)
+            self.rates[rate] = history
+        return history
+
+    def _running_tier(self, history, chunksize):
+        if chunksize is None:
+            return history.tier
+        return self._tier_for(chunksize)
+
+    def chunksize(self, rate, default=None):
+        """
+        Return the chosen chunksize for a rate.
+        """
+        return self.tiers[self._history(rate, default, time.monotonic()).tier]
+
+    def _step_up(self, history, rate, now, reason):
+        if history.stepped_down:
+            # The smaller tier did not work, wait longer before trying it again
+            history.failed_step_downs = min(history.failed_step_downs + 1, MAX_FAILED_STEP_DOWNS)
+        history.stepped_down = False
+        history.stable_since = now
+        history.low_buffer_count = 0
+        if history.tier == len(self.tiers) - 1:
+            print(f"{reason} at {rate} Hz, already using the largest chunksize")
+            return False
+        history.tier += 1
+        print(f"{reason} at {rate} Hz, increasing chunksize to {self.tiers[history.tier]}")
+        return True
+
+    def record_error(self, rate, chunksize=None, now=None):
+        """
+        Record a capture or playback error.
+        Returns True if the chunksize for the rate was changed.
+        """
+        if now is None:
+            now = time.monotonic()
+        history = self._history(rate, chunksize, now)
+        self._leave_pending(history, chunksize)
+        return self._step_up(history, rate, now, "Stopped by an error")
+
+    def _leave_pending(self, history, chunksize):
+        running = self._running_tier(history, chunksize)
+        if running != history.tier:
+            # A step down was not applied yet, the problem is with the running tier
+            history.tier = running
+            history.stepped_down = False
+
+    def observe(self, rate, buffer_level, rate_adjust, chunksize=None, now=None):
+        """
+        Record a sample of the buffer level and rate adjust while running.
+        Returns True if the chunksize for the rate was increased, and should be applied at once.
+        A decrease is only returned by chunksize() and apply().
+        """
+        if now is None:
+            now = time.monotonic()
+        history = self._history(rate, chunksize, now)
+        running = self._running_tier(history, chunksize)
+        size = self.tiers[running]
+        if buffer_level is not None and buffer_level < self.min_buffer_fraction * size:
+            history.low_buffer_count += 1
+            history.stable_since = now
+            if history.low_buffer_count >= self.low_buffer_samples:
+                self._leave_pending(history, chunksize)
+                return self._step_up(history, rate, now, "Buffer level is low")
+            return False
+        history.low_buffer_count = 0
+        if rate_adjust is not None and abs(rate_adjust - 1.0) > self.max_rate_deviation:
+            history.stable_since = now
+            return False
+        if running != history.tier:
+            # The chosen tier is not running yet, the stable period starts when it is
+            history.stable_since = now
+            return False
+        if history.stepped_down and now - history.stable_since >= self.stable_time:
+            # The smaller tier works
+            history.stepped_down = False
+        stable_time = self.stable_time * 2 ** history.failed_step_downs
+        if history.tier > 0 and not history.stepped_down and now - history.stable_since >= stable_time:
+            history.tier -= 1
+            history.stable_since = now
+            history.stepped_down = True
+            print(
+                f"Stable at {rate} Hz, decreasing chunksize to {self.tiers[history.tier]} at the next start"
+            )
+        return False
+
+    def apply(self, prepared, min_chunksize=None):
+        """
+        Return a PreparedConfig with the chunksize chosen for the rate of the given config.
+        The chunksize is not made smaller than 'min_chunksize',
+        this keeps the running chunksize until a step down can be applied.
+        The same object is returned for the same config and chunksize,
+        so that an unchanged choice does not look like a new config.
+        """
+        if prepared is None:
+            return None
+        devices = prepared.config.get("devices", {})
+        rate = devices.get("samplerate")
+        old_size = devices.get("chunksize")
+        size = self.chunksize(rate, old_size)
+        if min_chunksize is not None:
+            size = max(size, min_chunksize)
+        if size == old_size:
+            return prepared
+        key = (id(prepared), size)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.move_to_end(key)
+            return cached[1]
+        # Copy only the parts that are modified, the rest is shared with the original config
+        config = dict(prepared.config)
+        config["devices"] = dict(devices)
+        config["devices"]["chunksize"] = size
+        if devices.get("target_level") is not None and old_size:
+            config["devices"]["target_level"] = devices["target_level"] * size // old_size
+        tuned = PreparedConfig(config)
+        # Keep a reference to the original, so that its id is not reused while cached
+        self.cache[key] = (prepared, tuned)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return tuned
+
+    def as_dict(self):
+        return {str(rate): self.tiers[history.tier] for rate, history in self.rates.items()}
@@ -0,0 +1,135 @@
+import time
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKET_BOUNDS_MS = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000
+)
+
+# The stages of a switch, in the order they normally happen
+SWITCH_STAGES = (
+    "debounce",
+    "queue",
+    "dequeue",
+    "config_lookup",
+    "stop",
+    "set_active",
+    "running",
+)
+
+
+class Histogram:
+    """
+    A histogram of durations, with fixed buckets.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value_ms):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, value_ms)] += 1
+        self.count += 1
+        self.total += value_ms
+        if self.min is None or value_ms < self.min:
+            self.min = value_ms
+        if self.max is None or value_ms > self.max:
+            self.max = value_ms
+
+    def as_dict(self):
+        buckets = {}
+        for bound, count in zip(BUCKET_BOUNDS_MS + ("inf",), self.buckets):
+            if count > 0:
+                buckets[f"le_{bound}"] = count
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count > 0 else None,
+            "min_ms": self.min,
+            "max_ms": self.max,
+            "buckets": buckets,
+        }
+
+
+class SwitchMetrics:
+    """
+    Collect the duration of each stage of a wave format switch,
+    from the device event to CamillaDSP reporting that it is running.
+    A switch is started with start_switch().
+    Each call to mark() records the time since the previous mark
+    (or since the start) in the histogram of the given stage.
+    The switch ends with finish_switch(), that records the total time.
+    All timestamps are from time.monotonic().
+    Marks are ignored when no switch is in progress.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {stage: Histogram() for stage in SWITCH_STAGES}
+        self.total = Histogram()
+        self.reconnects = Histogram()
+        self.switch_start = None
+        self.last_mark = None
+        self.switches = 0
+
+    def start_switch(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.lock:
+            self.switch_start = timestamp
+            self.last_mark = timestamp
+
+    def in_progress(self):
+        return self.switch_start is not None
+
+    def mark(self, stage, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.lock:
+            if self.switch_start is None:
+                return
+            self.histograms[stage].add(1000 * (timestamp - self.last_mark))
+            self.last_mark = timestamp
+
+    def finish_switch(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.lock:
+            if self.switch_start is None:
+                return
+            self.total.add(1000 * (timestamp - self.switch_start))
+            self.switches += 1
+            self.switch_start = None
+            self.last_mark = None
+
+    def cancel_switch(self):
+        with self.lock:
+            self.switch_start = None
+            self.last_mark = None
+
+    def record_reconnect(self, lost_time, timestamp=None):
+        """
+        Record the duration of an outage of the CamillaDSP connection.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.lock:
+            self.reconnects.add(1000 * (timestamp - lost_time))
+
+    def dump(self):
+        """
+        Return the collected metrics as a dictionary.
+        """
+        with self.lock:
+            return {
+                "switches": self.switches,
+                "total": self.total.as_dict(),
+                "reconnects": self.reconnects.as_dict(),
+                "stages": {
+                    stage: histogram.as_dict()
+                    for stage, histogram in self.histograms.items()
+                },
+            }
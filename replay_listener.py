@@ -0,0 +1,73 @@
+import sys
+import time
+import threading
+from dataclasses import replace
+
+from datastructures import WaveFormat, DeviceEvent
+from device_listener import DeviceListener
+from event_trace import load_trace, trace_events
+
+
+class ReplayListener(DeviceListener):
+    """
+    A device listener that replays the listener events of a recorded trace.
+    With 'realtime', the events are sent with the same intervals as when they were recorded.
+    Otherwise they are sent as fast as possible.
+    If 'device' is given, only the events from that device are replayed.
+    The 'done' attribute is a threading.Event that is set when all events have been sent.
+    """
+
+    def __init__(self, filename, device=None, realtime=True):
+        self.events = trace_events(load_trace(filename), device=device)
+        self.realtime = realtime
+        self.on_change = None
+        self.done = threading.Event()
+        self.thread = None
+        # The format before the first event, taken from the first STARTED event
+        self.wave_format = WaveFormat(None, None, None)
+        for event in self.events:
+            if event.kind == DeviceEvent.STARTED:
+                self.wave_format = event.wave_format
+                break
+
+    def set_on_change(self, function):
+        self.on_change = function
+
+    def read_wave_format(self):
+        return self.wave_format
+
+    def replay(self):
+        if len(self.events) > 0:
+            start = time.monotonic()
+            first = self.events[0].timestamp
+            for event in self.events:
+                if self.realtime:
+                    delay = start + (event.timestamp - first) - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                now = time.monotonic()
+                if event.wave_format is not None:
+                    self.wave_format = event.wave_format
+                if self.metrics is not None:
+                    self.metrics.start_switch(now)
+                if self.on_change is not None:
+                    # Send the event as if it happened now
+                    self.on_change(replace(event, timestamp=now))
+        print(f"Replayed {len(self.events)} events")
+        self.done.set()
+
+    def run(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.replay, daemon=True)
+            self.thread.start()
+
+
+if __name__ == "__main__":
+    listener = ReplayListener(sys.argv[1])
+
+    def notifier(params):
+        print(params)
+
+    listener.set_on_change(notifier)
+    listener.run()
+    listener.done.wait()
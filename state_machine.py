@@ -0,0 +1,163 @@
+from enum import Enum, auto
+
+from camilladsp import ProcessingState
+
+RUNNING_STATES = (
+    ProcessingState.RUNNING,
+    ProcessingState.PAUSED,
+    ProcessingState.STALLED,
+    ProcessingState.STARTING,
+)
+
+
+class DspState(Enum):
+    """
+    The state of CamillaDSP, as known by the controller.
+    """
+    UNKNOWN = auto()
+    STOPPED = auto()
+    RUNNING = auto()
+    # The last config was rejected by CamillaDSP
+    FAILED = auto()
+
+
+class ConfigChange(Enum):
+    """
+    The difference between the wanted config and the last config sent to CamillaDSP.
+    """
+    NONE = auto()
+    # Only sections that can be updated without a restart differ
+    RELOAD = auto()
+    # The devices differ, or there is no previous config
+    RESTART = auto()
+
+
+class Action(Enum):
+    """
+    Commands that the controller can send to CamillaDSP.
+    """
+    STOP = auto()
+    # Send a new config to a stopped CamillaDSP
+    START = auto()
+    # Send a new config to a running CamillaDSP, that applies it without restarting
+    RELOAD = auto()
+
+
+# The actions needed to get from the current state to the desired state,
+# keyed by (current state, desired running, config change).
+TRANSITIONS = {
+    (DspState.UNKNOWN, False, ConfigChange.NONE): [Action.STOP],
+    (DspState.UNKNOWN, False, ConfigChange.RELOAD): [Action.STOP],
+    (DspState.UNKNOWN, False, ConfigChange.RESTART): [Action.STOP],
+    (DspState.UNKNOWN, True, ConfigChange.NONE): [Action.STOP, Action.START],
+    (DspState.UNKNOWN, True, ConfigChange.RELOAD): [Action.STOP, Action.START],
+    (DspState.UNKNOWN, True, ConfigChange.RESTART): [Action.STOP, Action.START],
+    (DspState.STOPPED, False, ConfigChange.NONE): [],
+    (DspState.STOPPED, False, ConfigChange.RELOAD): [],
+    (DspState.STOPPED, False, ConfigChange.RESTART): [],
+    (DspState.STOPPED, True, ConfigChange.NONE): [Action.START],
+    (DspState.STOPPED, True, ConfigChange.RELOAD): [Action.START],
+    (DspState.STOPPED, True, ConfigChange.RESTART): [Action.START],
+    (DspState.RUNNING, False, ConfigChange.NONE): [Action.STOP],
+    (DspState.RUNNING, False, ConfigChange.RELOAD): [Action.STOP],
+    (DspState.RUNNING, False, ConfigChange.RESTART): [Action.STOP],
+    (DspState.RUNNING, True, ConfigChange.NONE): [],
+    (DspState.RUNNING, True, ConfigChange.RELOAD): [Action.RELOAD],
+    (DspState.RUNNING, True, ConfigChange.RESTART): [Action.STOP, Action.START],
+    # Don't retry a config that was rejected, until it has been stopped or the config changes.
+    # A rejected config may leave the previous one running, so stop before starting a new one.
+    (DspState.FAILED, False, ConfigChange.NONE): [Action.STOP],
+    (DspState.FAILED, False, ConfigChange.RELOAD): [Action.STOP],
+    (DspState.FAILED, False, ConfigChange.RESTART): [Action.STOP],
+    (DspState.FAILED, True, ConfigChange.NONE): [],
+    (DspState.FAILED, True, ConfigChange.RELOAD): [Action.STOP, Action.START],
+    (DspState.FAILED, True, ConfigChange.RESTART): [Action.STOP, Action.START],
+}
+
+
+def config_diff(old, new):
+    """
+    Return the set of top level sections that differ between two configs.
+    """
+    if old is new:
+        return set()
+    return set(
+        section
+        for section in set(old) | set(new)
+        if old.get(section) != new.get(section)
+    )
+
+
+def classify_change(old, new):
+    """
+    Classify the change between two configs, given as PreparedConfig or None.
+    """
+    if old is None or new is None:
+        return ConfigChange.RESTART
+    changed = config_diff(old.config, new.config)
+    if len(changed) == 0:
+        return ConfigChange.NONE
+    if "devices" in changed:
+        return ConfigChange.RESTART
+    return ConfigChange.RELOAD
+
+
+class ControllerState:
+    """
+    Keeps track of the state of CamillaDSP, the last config sent to it,
+    and whether it should be running.
+    plan() returns the actions needed to reach the desired state,
+    and the controller reports the results of the actions back.
+    """
+
+    def __init__(self):
+        self.dsp_state = DspState.UNKNOWN
+        self.active_config = None
+        self.desired_running = True
+        # True after a reconnect, until a config has been sent.
+        # CamillaDSP may have been restarted with another config, so the active config is sent again.
+        self.config_unconfirmed = False
+
+    def plan(self, config):
+        """
+        Return the list of actions needed to run the given config,
+        or to stop if it should not be running or there is no config.
+        """
+        desired = self.desired_running and config is not None
+        change = classify_change(self.active_config, config)
+        if change == ConfigChange.NONE and self.config_unconfirmed:
+            change = ConfigChange.RELOAD
+        return TRANSITIONS[(self.dsp_state, desired, change)]
+
+    def stopped(self):
+        self.dsp_state = DspState.STOPPED
+
+    def started(self, config):
+        self.dsp_state = DspState.RUNNING
+        self.active_config = config
+        self.config_unconfirmed = False
+
+    def start_failed(self, config):
+        self.dsp_state = DspState.FAILED
+        self.active_config = config
+        self.config_unconfirmed = False
+
+    def connection_lost(self):
+        self.dsp_state = DspState.UNKNOWN
+        self.config_unconfirmed = True
+
+    def forget_config(self):
+        """
+        Forget the active config, when CamillaDSP is known to run another one.
+        """
+        self.active_config = None
+
+    def observe(self, state):
+        """
+        Update the state from a state reported by CamillaDSP.
+        """
+        if state in RUNNING_STATES:
+            if self.dsp_state != DspState.FAILED:
+                self.dsp_state = DspState.RUNNING
+        elif self.dsp_state != DspState.FAILED:
+            self.dsp_state = DspState.STOPPED
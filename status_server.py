@@ -0,0 +1,174 @@
+import os
+import json
+import stat
+import socket
+import threading
+import socketserver
+
+from datastructures import DeviceEvent, WaveFormat, ListenerEvent
+
+
+class StatusServer:
+    """
+    Serve the state known by the controller on a Unix socket,
+    so that local clients don't need their own connection to CamillaDSP.
+    The protocol is json, one message per line.
+    Requests are objects with a "command" field:
+    - {"command": "status"}: reply with the current status.
+    - {"command": "subscribe"}: reply with the current status,
+      and then send the new status every time it changes.
+    - {"command": "switch", "sample_rate": 48000, "sample_format": "S32LE", "channels": 2}:
+      switch as if the device had started with this wave format.
+      The fields that are left out are None.
+      The sample rate and channels must be positive integers, and the format a string.
+    - {"command": "stop"}: stop as if the device had stopped.
+    Status messages are sent as {"status": {...}},
+    and replies to commands as {"result": "Ok"} or {"result": "Error", "message": "..."}.
+    Each client is served by its own thread.
+    """
+
+    def __init__(self, path, on_command):
+        self.path = path
+        # Called with a ListenerEvent for each switch or stop command
+        self.on_command = on_command
+        self.cond = threading.Condition()
+        self.status = {}
+        self.version = 0
+        self.server = None
+        self.thread = None
+
+    def publish(self, status):
+        """
+        Set a new status, and send it to all subscribers.
+        """
+        with self.cond:
+            if status == self.status:
+                return
+            self.status = status
+            self.version += 1
+            self.cond.notify_all()
+
+    def current(self):
+        with self.cond:
+            return self.version, self.status
+
+    def wait_for_change(self, version, timeout=None):
+        """
+        Wait until the status is newer than the given version.
+        Returns the new version and status.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != version, timeout)
+            return self.version, self.status
+
+    def handle_request(self, request):
+        command = request.get("command")
+        if command == "switch":
+            for field in ("sample_rate", "channels"):
+                value = request.get(field)
+                # bool is a subclass of int, but not a valid value
+                if value is not None and (
+                    not isinstance(value, int) or isinstance(value, bool) or value <= 0
+                ):
+                    return {"result": "Error", "message": f"Invalid {field}: {value!r}"}
+            sample_format = request.get("sample_format")
+            if sample_format is not None and not isinstance(sample_format, str):
+                return {"result": "Error", "message": f"Invalid sample_format: {sample_format!r}"}
+            wave_format = WaveFormat(request.get("sample_rate"), sample_format, request.get("channels"))
+            self.on_command(ListenerEvent(DeviceEvent.STARTED, wave_format, "api"))
+        elif command == "stop":
+            self.on_command(ListenerEvent(DeviceEvent.STOPPED, None, "api"))
+        else:
+            return {"result": "Error", "message": f"Unknown command: {command}"}
+        return {"result": "Ok"}
+
+    def run(self):
+        if self.thread is not None:
+            return
+        # Remove a socket left behind by an earlier run
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        status_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    for line in self.rfile:
+                        if not line.strip():
+                            continue
+                        try:
+                            request = json.loads(line)
+                        except ValueError as e:
+                            self.send({"result": "Error", "message": f"Invalid request: {e}"})
+                            continue
+                        if not isinstance(request, dict):
+                            self.send({"result": "Error", "message": "The request must be an object"})
+                            continue
+                        if request.get("command") == "status":
+                            self.send({"status": status_server.current()[1]})
+                        elif request.get("command") == "subscribe":
+                            self.subscribe()
+                            return
+                        else:
+                            self.send(status_server.handle_request(request))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def subscribe(self):
+                version, status = status_server.current()
+                while True:
+                    self.send({"status": status})
+                    version, status = status_server.wait_for_change(version)
+
+            def send(self, message):
+                self.wfile.write(json.dumps(message).encode() + b"\n")
+                self.wfile.flush()
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self.server = Server(self.path, Handler)
+        print("Serving status on", self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            self.thread = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def status_client(path, request):
+    """
+    Send a request to a status server, and yield the replies.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python status_server.py SOCKET_PATH [status|subscribe|stop|switch RATE]
+    path = sys.argv[1]
+    command = sys.argv[2] if len(sys.argv) > 2 else "status"
+    request = {"command": command}
+    if command == "switch":
+        request["sample_rate"] = int(sys.argv[3])
+    for reply in status_client(path, request):
+        print(json.dumps(reply))
+        if command != "subscribe":
+            break